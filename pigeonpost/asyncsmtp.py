@@ -0,0 +1,396 @@
+"""
+An outbox engine that sends messages over many non-blocking SMTP connections
+at once, all driven by a single asyncore loop in a background thread.
+
+It speaks SMTP itself rather than going through EMAIL_BACKEND, using
+EMAIL_HOST, EMAIL_PORT, EMAIL_HOST_USER and EMAIL_HOST_PASSWORD. Envelope
+commands are pipelined when the server supports PIPELINING. TLS is not
+supported, so with EMAIL_USE_TLS or EMAIL_USE_SSL process_outbox falls back
+to the threaded engine.
+"""
+import time
+import base64
+import socket
+import logging
+import asyncore
+import asynchat
+import smtplib
+import threading
+from collections import OrderedDict, deque
+from Queue import Queue, Empty
+
+from django.conf import settings
+from django.core.mail.message import sanitize_address
+
+from pigeonpost.sending import send_fanout, send_message
+
+send_logger = logging.getLogger('pigeonpost.send')
+
+CRLF = '\r\n'
+
+
+def supported():
+    """ Whether the async engine can be used with the current mail settings """
+    return not (getattr(settings, 'EMAIL_USE_TLS', False) or getattr(settings, 'EMAIL_USE_SSL', False))
+
+
+class Job(object):
+    """
+    A message waiting to be sent, with its SMTP envelope. If ``addresses``
+    maps the envelope recipients to the addresses they came from, the result
+    is the set of those addresses that the message was delivered to, as with
+    sending.send_fanout.
+    """
+
+    def __init__(self, key, from_email, recipients, data, addresses=None):
+        self.key = key
+        self.from_email = from_email
+        self.recipients = recipients
+        self.data = data
+        self.addresses = addresses
+        self.refused = set()
+        self.attempts = 0
+
+
+class SMTPClient(asynchat.async_chat):
+    """
+    A single non-blocking SMTP connection. Once the greeting, EHLO (or HELO)
+    and any AUTH are done, the sender hands it one Job at a time.
+    """
+
+    def __init__(self, sender):
+        asynchat.async_chat.__init__(self, map=sender.map)
+        self.sender = sender
+        self.set_terminator(CRLF)
+        self.buffer = []
+        self.lines = []
+        self.handlers = deque()
+        self.commands = deque()
+        self.pipelining = False
+        self.ready = False
+        self.greeted = False
+        self.lost = False
+        self.job = None
+        self.last_activity = time.time()
+        self.handlers.append(self._on_greeting)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            self.connect((sender.host, sender.port))
+        except socket.error:
+            self.close()
+            raise
+
+    # Reading replies
+
+    def collect_incoming_data(self, data):
+        self.buffer.append(data)
+
+    def found_terminator(self):
+        line = ''.join(self.buffer)
+        self.buffer = []
+        self.lines.append(line)
+        self.last_activity = time.time()
+        if line[3:4] == '-':
+            # Multiline reply, wait for the rest
+            return
+        try:
+            code = int(line[:3])
+        except ValueError:
+            code = 500
+        lines, self.lines = self.lines, []
+        if code == 421:
+            # The server is closing the connection
+            self.handle_close()
+            return
+        if self.handlers:
+            self.handlers.popleft()(code, lines)
+
+    def command(self, line, handler):
+        self.handlers.append(handler)
+        self.push(line + CRLF)
+
+    # Connection setup
+
+    def _on_greeting(self, code, lines):
+        if code != 220:
+            return self.handle_close()
+        self.command('EHLO %s' % self.sender.local_hostname, self._on_ehlo)
+
+    def _on_ehlo(self, code, lines):
+        if code != 250:
+            return self.command('HELO %s' % self.sender.local_hostname, self._on_helo)
+        extensions = [line[4:].strip().upper() for line in lines[1:]]
+        self.pipelining = 'PIPELINING' in extensions
+        self._authenticate()
+
+    def _on_helo(self, code, lines):
+        if code != 250:
+            return self.handle_close()
+        self._authenticate()
+
+    def _authenticate(self):
+        if not self.sender.username:
+            return self._greeted()
+        credentials = u'\0%s\0%s' % (self.sender.username, self.sender.password)
+        credentials = credentials.encode('utf-8')
+        self.command('AUTH PLAIN %s' % base64.b64encode(credentials), self._on_auth)
+
+    def _on_auth(self, code, lines):
+        if code != 235:
+            send_logger.error("Authentication failed: %s" % ' '.join(lines))
+            return self.handle_close()
+        self._greeted()
+
+    def _greeted(self):
+        self.greeted = True
+        self.ready = True
+        self.sender.connected(self)
+
+    # Sending a message
+
+    def send_job(self, job):
+        self.ready = False
+        self.job = job
+        self.job.refused = set()
+        self.accepted = 0
+        self.rcpts = 0
+        self.failed = False
+        commands = [('MAIL FROM:<%s>' % job.from_email, self._on_mail)]
+        commands += [('RCPT TO:<%s>' % r, self._on_rcpt) for r in job.recipients]
+        commands.append(('DATA', self._on_data))
+        if self.pipelining:
+            # Send the whole envelope at once, and read the replies as they come
+            self.push(''.join(line + CRLF for line, handler in commands))
+            self.handlers.extend(handler for line, handler in commands)
+        else:
+            self.commands.extend(commands)
+            self._next_command()
+
+    def _next_command(self):
+        if self.commands:
+            line, handler = self.commands.popleft()
+            self.command(line, handler)
+
+    def _on_mail(self, code, lines):
+        if code != 250:
+            send_logger.error("Sender %s refused: %s" % (self.job.from_email, ' '.join(lines)))
+            self.failed = True
+            if not self.pipelining:
+                return self._abort()
+        self._next_command()
+
+    def _on_rcpt(self, code, lines):
+        recipient = self.job.recipients[self.rcpts]
+        self.rcpts += 1
+        if code in (250, 251):
+            self.accepted += 1
+        else:
+            send_logger.error("Recipient refused: %s" % ' '.join(lines))
+            self.job.refused.add(recipient)
+        if not self.pipelining and self.commands[0][0] == 'DATA' and not self.accepted:
+            # Every recipient was refused, so don't bother with DATA
+            return self._abort()
+        self._next_command()
+
+    def _on_data(self, code, lines):
+        if code != 354:
+            return self._abort()
+        if self.failed or not self.accepted:
+            # A pipelining server accepted DATA after refusing the envelope
+            self.push('.' + CRLF)
+            self.handlers.append(lambda code, lines: self._abort())
+            return
+        data = smtplib.quotedata(self.job.data)
+        if data[-2:] != CRLF:
+            data += CRLF
+        self.handlers.append(self._on_sent)
+        self.push(data + '.' + CRLF)
+
+    def _on_sent(self, code, lines):
+        if code != 250:
+            send_logger.error("Message refused: %s" % ' '.join(lines))
+        self._finish(code == 250)
+
+    def _abort(self):
+        self.commands.clear()
+        self.handlers.clear()
+        self.command('RSET', lambda code, lines: self._finish(False))
+
+    def _finish(self, succeeded):
+        job, self.job = self.job, None
+        self.ready = True
+        self.sender.finished(job, succeeded)
+
+    # Connection lifecycle
+
+    def quit(self):
+        self.ready = False
+        self.command('QUIT', lambda code, lines: self.close())
+
+    def handle_close(self):
+        if self.lost:
+            return
+        self.lost = True
+        self.ready = False
+        self.close()
+        self.sender.lost(self)
+
+    def handle_error(self):
+        if self.greeted:
+            send_logger.exception("SMTP connection to %s:%s failed" % (self.sender.host, self.sender.port))
+        else:
+            send_logger.warning("Couldn't connect to the mail server %s:%s" % (self.sender.host, self.sender.port))
+        self.handle_close()
+
+
+class AsyncSender(object):
+    """
+    Sends messages over up to PIGEONPOST_ASYNC_CONNECTIONS SMTP connections,
+    multiplexed on one thread.
+
+    It has the same interface as sending.ConcurrentSender: messages are
+    submitted from the calling thread, which also collects the results and
+    writes them to the database. Messages that are dropped along with their
+    connection are retried once on another connection. If the server can't
+    be connected to, ``unavailable`` is set and the remaining messages are
+    returned with a result of None.
+    """
+
+    def __init__(self, connections=None):
+        self.host = settings.EMAIL_HOST
+        self.port = int(settings.EMAIL_PORT)
+        self.username = getattr(settings, 'EMAIL_HOST_USER', '')
+        self.password = getattr(settings, 'EMAIL_HOST_PASSWORD', '')
+        self.timeout = getattr(settings, 'EMAIL_TIMEOUT', None) or 60
+        self.local_hostname = socket.getfqdn()
+        self.max_connections = connections or getattr(settings, 'PIGEONPOST_ASYNC_CONNECTIONS', 20)
+        self.connect_attempts = getattr(settings, 'PIGEONPOST_SMTP_CONNECT_ATTEMPTS', 3)
+        self.map = {}
+        self.clients = []
+        self.jobs = deque()
+        self.slots = threading.Semaphore(4 * self.max_connections)
+        self._results = Queue()
+        self.connect_failures = 0
+        self.unavailable = False
+        self.closing = False
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    # Called from the calling thread
+
+    def submit(self, key, email, route=None, send=send_message):
+        """
+        Queue an email to be sent, blocking while too many are in flight.
+        Every connection goes to EMAIL_HOST, so ``route`` makes no difference.
+        With ``send=send_fanout``, the result is the set of recipients the
+        email was delivered to, as with sending.ConcurrentSender.
+        """
+        encoding = email.encoding or settings.DEFAULT_CHARSET
+        # Sanitized addresses are ASCII, but may still be unicode objects
+        addresses = OrderedDict((sanitize_address(addr, encoding).encode('ascii'), addr)
+                for addr in email.recipients())
+        job = Job(key, sanitize_address(email.from_email, encoding).encode('ascii'),
+                list(addresses), email.message().as_bytes(linesep=CRLF),
+                addresses if send is send_fanout else None)
+        self.slots.acquire()
+        self.jobs.append(job)
+
+    def results(self):
+        """ Yields the (key, result) of the messages sent so far """
+        while True:
+            try:
+                yield self._results.get_nowait()
+            except Empty:
+                return
+
+    def close(self):
+        """ Wait for the queued messages to be sent, and close the connections """
+        self.closing = True
+        self.thread.join()
+
+    # Called from the loop thread
+
+    def _run(self):
+        while not (self.closing and not self.jobs and not any(c.job for c in self.clients)):
+            self._dispatch()
+            self._check_timeouts()
+            if self.map:
+                asyncore.loop(timeout=0.05, map=self.map, count=1)
+            else:
+                time.sleep(0.05)
+        for client in list(self.clients):
+            client.quit()
+        deadline = time.time() + 5
+        while self.map and time.time() < deadline:
+            asyncore.loop(timeout=0.05, map=self.map, count=1)
+        for client in list(self.map.values()):
+            client.close()
+
+    def _dispatch(self):
+        if self.unavailable:
+            while self.jobs:
+                self._result(self.jobs.popleft(), None)
+            return
+        for client in self.clients:
+            if not self.jobs:
+                break
+            if client.ready:
+                client.send_job(self.jobs.popleft())
+        # Open more connections while there is more work than connections
+        connecting = len([c for c in self.clients if not c.greeted])
+        while (self.jobs and len(self.clients) < self.max_connections and
+                connecting < len(self.jobs)):
+            try:
+                self.clients.append(SMTPClient(self))
+            except socket.error as err:
+                send_logger.warning("Couldn't connect to the mail server: %s" % err)
+                self._connect_failed()
+                break
+            connecting += 1
+
+    def _check_timeouts(self):
+        cutoff = time.time() - self.timeout
+        for client in list(self.clients):
+            if (client.job or not client.greeted) and client.last_activity < cutoff:
+                send_logger.warning("SMTP connection timed out")
+                client.handle_close()
+
+    def _result(self, job, succeeded):
+        self._results.put((job.key, succeeded))
+        self.slots.release()
+
+    def _connect_failed(self):
+        self.connect_failures += 1
+        if self.connect_failures >= self.connect_attempts and not self.clients:
+            send_logger.error("Couldn't connect to the mail server after %d attempts" %
+                    self.connect_failures)
+            self.unavailable = True
+
+    def connected(self, client):
+        self.connect_failures = 0
+
+    def finished(self, job, succeeded):
+        if succeeded:
+            send_logger.debug("Message sent!")
+        else:
+            send_logger.debug("Message failed!")
+        if job.addresses is not None:
+            succeeded = set(addr for rcpt, addr in job.addresses.items()
+                    if succeeded and rcpt not in job.refused)
+        self._result(job, succeeded)
+
+    def lost(self, client):
+        if client in self.clients:
+            self.clients.remove(client)
+        if not client.greeted:
+            self._connect_failed()
+        job = client.job
+        if job is None:
+            return
+        job.attempts += 1
+        if job.attempts < 2:
+            send_logger.warning("Lost the connection to the mail server, retrying message")
+            self.jobs.appendleft(job)
+        else:
+            self.finished(job, False)
@@ -0,0 +1,123 @@
+"""
+Content-addressed storage for the large parts of Outbox messages.
+
+With PIGEONPOST_BLOB_MIN_SIZE set, the json serialiser moves message bodies,
+alternatives and attachments of at least that many bytes out of the payload.
+They are stored once in the Blob table, keyed by their SHA-256, however many
+Outbox messages include them, and Outbox.blobs records which messages refer
+to which blobs. collect_garbage() deletes the blobs that no message refers to
+any more.
+
+Blobs are stored before the messages that refer to them, so a blob is only
+collected once it has been unreferenced for PIGEONPOST_BLOB_GRACE seconds.
+"""
+import datetime
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils.timezone import now
+
+from pigeonpost.models import Blob, Outbox
+
+
+def enabled():
+    """ Whether new messages are stored with blobs """
+    return bool(getattr(settings, 'PIGEONPOST_BLOB_MIN_SIZE', 0))
+
+
+def _insert(model, objs):
+    """ Insert rows in one query, or one at a time skipping those that already exist """
+    if not objs:
+        return
+    try:
+        with transaction.atomic():
+            model.objects.bulk_create(objs)
+    except IntegrityError:
+        for obj in objs:
+            try:
+                with transaction.atomic():
+                    obj.save(force_insert=True)
+            except IntegrityError:
+                pass
+
+
+def store(blobs, stored=None):
+    """
+    Save a dict of hash: data to the Blob table. ``stored`` is a set of the
+    hashes already saved by the caller, which are skipped, and it is updated
+    with the new ones.
+    """
+    hashes = set(blobs)
+    if stored is not None:
+        hashes -= stored
+    if not hashes:
+        return
+    existing = set(Blob.objects.filter(hash__in=hashes).values_list('hash', flat=True))
+    if existing:
+        # Keep them from being collected before they are linked
+        Blob.objects.filter(hash__in=existing).update(stored_at=now())
+    # Another worker may store the same blob in the meantime
+    _insert(Blob, [Blob(hash=key, data=blobs[key]) for key in hashes - existing])
+    if stored is not None:
+        stored.update(hashes)
+
+
+def link(refs):
+    """ Record which blobs Outbox messages refer to, from a dict of Outbox id: hashes """
+    Link = Outbox.blobs.through
+    _insert(Link, [Link(outbox_id=pk, blob_id=key) for pk, hashes in refs.items() for key in hashes])
+
+
+class BlobCache(object):
+    """
+    The blobs for serializers.loads, loaded from the Blob table as they are
+    needed and kept for the next message, up to ``max_size`` bytes.
+    """
+
+    def __init__(self, max_size=32 * 1024 * 1024):
+        self.max_size = max_size
+        self.size = 0
+        self.blobs = {}
+
+    def _add(self, key, data):
+        data = bytes(data)
+        if self.size + len(data) > self.max_size:
+            self.blobs = {}
+            self.size = 0
+        self.blobs[key] = data
+        self.size += len(data)
+
+    def prefetch(self, outbox_ids):
+        """ Load the blobs that any of the Outbox messages refer to, with at most two queries """
+        hashes = set(Outbox.blobs.through.objects.filter(outbox_id__in=outbox_ids)
+                .values_list('blob_id', flat=True))
+        missing = hashes - set(self.blobs)
+        if missing:
+            for key, data in Blob.objects.filter(hash__in=missing).values_list('hash', 'data'):
+                self._add(key, data)
+
+    def __getitem__(self, key):
+        if key not in self.blobs:
+            try:
+                self._add(key, Blob.objects.values_list('data', flat=True).get(hash=key))
+            except Blob.DoesNotExist:
+                raise KeyError(key)
+        return self.blobs[key]
+
+
+def collect_garbage(grace=None, batch_size=500):
+    """
+    Delete the blobs that no Outbox message refers to, and that were stored
+    more than ``grace`` seconds ago (default PIGEONPOST_BLOB_GRACE, or a
+    day). Returns how many were deleted.
+    """
+    if grace is None:
+        grace = getattr(settings, 'PIGEONPOST_BLOB_GRACE', 24 * 60 * 60)
+    unreferenced = Blob.objects.filter(outboxes=None, stored_at__lt=now() - datetime.timedelta(seconds=grace))
+    deleted = 0
+    while True:
+        hashes = list(unreferenced.values_list('hash', flat=True)[:batch_size])
+        if not hashes:
+            return deleted
+        # Check again, in case a message has started referring to one since
+        deleted += unreferenced.filter(hash__in=hashes).delete()[1].get(Blob._meta.label, 0)
@@ -0,0 +1,86 @@
+"""
+Coordinates several deploy_pigeons workers, possibly on different hosts,
+through the database rather than a pid file.
+
+Pigeons and Outbox messages are leased to a worker by setting claimed_by and
+claimed_until. Other workers skip rows with a lease that hasn't expired, so if
+a worker crashes its rows are picked up again once the lease runs out. On
+databases with SELECT ... FOR UPDATE SKIP LOCKED, the rows are also locked
+while they are being claimed, so workers don't wait on each other.
+"""
+import os
+import time
+import uuid
+import socket
+import datetime
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils.timezone import now
+
+
+def enabled():
+    """ Whether workers claim their work, rather than taking the pid file lock """
+    return getattr(settings, 'PIGEONPOST_CLAIM_WORK', False)
+
+
+class Claimer(object):
+    """ Claims rows for one run of a worker """
+
+    def __init__(self, lease=None):
+        if lease is None:
+            lease = getattr(settings, 'PIGEONPOST_CLAIM_LEASE', 300)
+        self.lease = datetime.timedelta(seconds=lease)
+        self.worker = '%s:%d:%s' % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        # When heartbeat() should next renew the leases, a third of the way through them
+        self.renew_at = None
+
+    def _leased(self):
+        self.renew_at = time.time() + self.lease.total_seconds() / 3
+
+    def claim(self, queryset, limit):
+        """
+        Lease up to ``limit`` rows of ``queryset`` that aren't leased to
+        another worker, returning their ids in the queryset's order.
+        """
+        model = queryset.model
+        unclaimed = queryset.filter(Q(claimed_until__isnull=True) | Q(claimed_until__lt=now()))
+        until = now() + self.lease
+        with transaction.atomic():
+            if connection.features.has_select_for_update_skip_locked:
+                unclaimed = unclaimed.select_for_update(skip_locked=True)
+            ids = list(unclaimed.values_list('id', flat=True)[:limit])
+            if not ids:
+                return []
+            # Without row locks, another worker may have claimed some of these
+            # since they were read, so the update checks the lease again
+            model.objects.filter(
+                Q(claimed_until__isnull=True) | Q(claimed_until__lt=now()), id__in=ids,
+            ).update(claimed_by=self.worker, claimed_until=until)
+        self._leased()
+        claimed = set(model.objects.filter(id__in=ids, claimed_by=self.worker).values_list('id', flat=True))
+        return [pk for pk in ids if pk in claimed]
+
+    def renew(self, model, ids):
+        """ Extend the lease on rows that are taking a while """
+        model.objects.filter(id__in=ids, claimed_by=self.worker).update(
+                claimed_until=now() + self.lease)
+
+    def heartbeat(self, model):
+        """
+        Renew the lease on every row of model this worker holds, once a third
+        of the lease has gone by, so rows that are slow to get through aren't
+        claimed by another worker. Call it often while working.
+        """
+        if self.renew_at is None or time.time() < self.renew_at:
+            return
+        model.objects.filter(claimed_by=self.worker).update(claimed_until=now() + self.lease)
+        self._leased()
+
+    def release(self, model, ids=None):
+        """ Give up the lease on rows, or on every row this worker has claimed """
+        claimed = model.objects.filter(claimed_by=self.worker)
+        if ids is not None:
+            claimed = claimed.filter(id__in=ids)
+        claimed.update(claimed_by=None, claimed_until=None)
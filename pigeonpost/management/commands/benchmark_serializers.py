@@ -0,0 +1,71 @@
+import time
+import pickle
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.mail import EmailMultiAlternatives
+
+from pigeonpost import serializers
+from pigeonpost.models import Outbox
+
+
+def legacy_dumps(email):
+    return pickle.dumps(email, 2).encode('base64')
+
+
+class Command(BaseCommand):
+    help = "Compares the size and speed of the Outbox message serialisers"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-n', '--messages',
+            default=200,
+            type=int,
+            dest='messages',
+            help="How many messages to take from the Outbox. If it is empty, a sample message is used instead.")
+        parser.add_argument(
+            '-r', '--repeat',
+            default=5,
+            type=int,
+            dest='repeat',
+            help="How many times to encode and decode each message.")
+
+    def handle(self, *args, **options):
+        if options['repeat'] < 1:
+            raise CommandError("--repeat must be at least 1")
+        emails = [serializers.loads(message) for message in
+                Outbox.objects.exclude(message=b'').order_by('-id').values_list('message', flat=True)[:options['messages']]]
+        if not emails:
+            emails = [self.sample_email()]
+        self.stdout.write("%d messages, %d times each\n" % (len(emails), options['repeat']))
+        self.stdout.write("%-22s %12s %12s %12s\n" % ('format', 'avg bytes', 'encode us', 'decode us'))
+        formats = [('legacy base64 pickle', legacy_dumps, lambda data: pickle.loads(data.decode('base64')))]
+        for name in ('pickle', 'json', 'mime'):
+            for compress in (False, True):
+                formats.append(('%s%s' % (name, ' + zlib' if compress else ''),
+                    lambda email, name=name, compress=compress: serializers.dumps(email, name, compress),
+                    serializers.loads))
+        for label, dumps, loads in formats:
+            size, encode, decode = self.measure(emails, dumps, loads, options['repeat'])
+            self.stdout.write("%-22s %12d %12.1f %12.1f\n" % (label, size, encode, decode))
+
+    def measure(self, emails, dumps, loads, repeat):
+        """ The average size, and encode and decode times in microseconds """
+        start = time.time()
+        for i in range(repeat):
+            payloads = [dumps(email) for email in emails]
+        encode = time.time() - start
+        start = time.time()
+        for i in range(repeat):
+            for payload in payloads:
+                loads(payload)
+        decode = time.time() - start
+        count = float(len(emails) * repeat)
+        size = sum(len(payload) for payload in payloads) / len(payloads)
+        return size, encode / count * 1e6, decode / count * 1e6
+
+    def sample_email(self):
+        body = "Hello Andrew,\n\n" + "Here is the latest news from the site. " * 40
+        email = EmailMultiAlternatives(subject="Latest news", body=body,
+                from_email="news@example.com", to=["andrew@example.com"])
+        email.attach_alternative("<html><body><p>%s</p></body></html>" % body, "text/html")
+        return email
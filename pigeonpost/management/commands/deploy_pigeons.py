@@ -1,5 +1,8 @@
+import signal
+import threading
+
 from django.core.management.base import BaseCommand, CommandError
-from pigeonpost.tasks import send_email
+from pigeonpost.tasks import send_email, run_pigeons
 
 class Command(BaseCommand):
     help = "Sends any pending emails in the ContentQueue"
@@ -11,6 +14,46 @@ class Command(BaseCommand):
             action='store_true',
             dest='dry_run',
             help="Create, but do not send messages that have been queued. Useful to help test a model's render_email method. Logs messages at level debug with the pigeonpost.dryrun logger.")
+        parser.add_argument(
+            '--engine',
+            default=None,
+            choices=['default', 'async'],
+            dest='engine',
+            help="How to send the outbox. 'async' sends over many non-blocking SMTP connections from one thread. Defaults to the PIGEONPOST_OUTBOX_ENGINE setting.")
+
+        parser.add_argument(
+            '--queue-only',
+            default=False,
+            action='store_true',
+            dest='queue_only',
+            help="Only add the pigeons that are due to the outbox, without sending it.")
+        parser.add_argument(
+            '--outbox-only',
+            default=False,
+            action='store_true',
+            dest='outbox_only',
+            help="Only send the messages in the outbox, without processing the queue.")
+        parser.add_argument(
+            '--daemon',
+            default=False,
+            action='store_true',
+            dest='daemon',
+            help="Keep running, sending pigeons as they become due, until stopped with SIGTERM or SIGINT. Waits at most PIGEONPOST_POLL_INTERVAL seconds between runs.")
 
     def handle(self, *args, **options):
-        send_email(dry_run=options['dry_run'])
+        if options['queue_only'] and options['outbox_only']:
+            raise CommandError("--queue-only and --outbox-only can't be used together")
+        if options['daemon']:
+            if options['dry_run']:
+                raise CommandError("--daemon and --dry-run can't be used together")
+            stop = threading.Event()
+            def shutdown(signum, frame):
+                # Messages already being sent are finished and recorded first
+                stop.set()
+            signal.signal(signal.SIGTERM, shutdown)
+            signal.signal(signal.SIGINT, shutdown)
+            run_pigeons(engine=options['engine'], queue=not options['outbox_only'],
+                    outbox=not options['queue_only'], stop=stop)
+            return
+        send_email(dry_run=options['dry_run'], engine=options['engine'],
+                queue=not options['outbox_only'], outbox=not options['queue_only'])
@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand, CommandError
+from pigeonpost.tasks import prune_pigeons
+
+class Command(BaseCommand):
+    help = "Deletes messages from the Outbox that were sent a while ago"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days',
+            default=None,
+            type=int,
+            dest='days',
+            help="Prune messages sent more than this many days ago. Defaults to the PIGEONPOST_RETENTION_DAYS setting, or 30.")
+        parser.add_argument(
+            '--strip-only',
+            default=None,
+            action='store_true',
+            dest='strip_only',
+            help="Keep the messages, but empty their payloads, so pigeons that are queued again still aren't sent to the same users.")
+        parser.add_argument(
+            '--no-summary',
+            default=None,
+            action='store_false',
+            dest='summary',
+            help="Don't record how many of each pigeon's messages were deleted.")
+        parser.add_argument(
+            '--batch-size',
+            default=None,
+            type=int,
+            dest='batch_size',
+            help="How many messages to prune at a time. Defaults to the PIGEONPOST_PRUNE_BATCH setting, or 500.")
+
+    def handle(self, *args, **options):
+        if options['days'] is not None and options['days'] < 0:
+            raise CommandError("--days can't be negative")
+        if options['batch_size'] is not None and options['batch_size'] < 1:
+            raise CommandError("--batch-size must be at least 1")
+        result = prune_pigeons(days=options['days'], strip_only=options['strip_only'],
+                summary=options['summary'], batch_size=options['batch_size'])
+        if result is None:
+            self.stderr.write("Another process is already pruning the outbox\n")
+            return
+        self.stdout.write("Pruned %d messages and %d blobs\n" % result)
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+# Indexes for the queries run by every deploy_pigeons:
+#
+#   Pigeon.objects.filter(to_send=True, scheduled_for__lte=...).order_by('scheduled_for')
+#   Outbox.objects.filter(succeeded=False, failures__lt=...).order_by('id')
+#
+# PostgreSQL gets partial indexes, which only contain the pigeons that are
+# still to be sent and the messages that haven't been delivered, so they stay
+# small as the history grows. Other backends get plain composite indexes.
+#
+# The outbox index isn't also limited to failures below max_retries, although
+# messages that have given up are never sent again. max_retries is an argument
+# to process_outbox, and PostgreSQL only uses a partial index for a query that
+# implies its WHERE clause, so a bound of the default 3 would stop the index
+# being used with a higher max_retries. Messages that give up are rare, so
+# they add little to the index.
+#
+# On PostgreSQL the indexes are built CONCURRENTLY, so that upgrading doesn't
+# lock out writes to a large outbox while they are built. That can't be done
+# in a transaction, so this migration isn't atomic.
+PARTIAL_INDEXES = [
+    ('pigeonpost_pigeon', 'pigeonpost_pigeon_due', '(scheduled_for) WHERE to_send'),
+    ('pigeonpost_outbox', 'pigeonpost_outbox_pending', '(id) WHERE NOT succeeded'),
+]
+
+INDEXES = [
+    ('pigeonpost_pigeon', 'pigeonpost_pigeon_due', '(to_send, scheduled_for)'),
+    ('pigeonpost_outbox', 'pigeonpost_outbox_pending', '(succeeded, id)'),
+]
+
+
+def create_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        indexes = PARTIAL_INDEXES
+        create = 'CREATE INDEX CONCURRENTLY'
+    else:
+        indexes = INDEXES
+        create = 'CREATE INDEX'
+    for table, name, definition in indexes:
+        schema_editor.execute('%s %s ON %s %s' % (
+            create, schema_editor.quote_name(name), schema_editor.quote_name(table), definition))
+
+
+def drop_indexes(apps, schema_editor):
+    for table, name, definition in INDEXES:
+        if schema_editor.connection.vendor == 'mysql':
+            schema_editor.execute('DROP INDEX %s ON %s' % (
+                schema_editor.quote_name(name), schema_editor.quote_name(table)))
+        elif schema_editor.connection.vendor == 'postgresql':
+            schema_editor.execute('DROP INDEX CONCURRENTLY %s' % schema_editor.quote_name(name))
+        else:
+            schema_editor.execute('DROP INDEX %s' % schema_editor.quote_name(name))
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('pigeonpost', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_indexes, drop_indexes),
+    ]
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+# Enforce the uniqueness that add_to_queue relies on, so that two processes
+# queueing the same pigeon at once can't create duplicates:
+#
+# * there is one pigeon per model instance, render_email_method, send_to and
+#   send_to_method, whether or not it has been sent;
+# * there is at most one unsent pigeon per model class, render_email_method,
+#   send_to and send_to_method.
+#
+# NULLs are never equal in a unique index, so the nullable columns are
+# coalesced. Only PostgreSQL and SQLite support these partial expression
+# indexes, and they are also the backends where add_to_queue uses an upsert.
+UNIQUE_INDEXES = [
+    ('pigeonpost_pigeon_source_uniq',
+     "(source_content_type_id, source_id, render_email_method, "
+     "COALESCE(send_to_id, 0), COALESCE(send_to_method, '')) "
+     "WHERE source_id IS NOT NULL"),
+    ('pigeonpost_pigeon_class_uniq',
+     "(source_content_type_id, render_email_method, "
+     "COALESCE(send_to_id, 0), COALESCE(send_to_method, '')) "
+     "WHERE source_id IS NULL AND to_send"),
+]
+
+
+def merge_duplicate_pigeons(apps, schema_editor):
+    """
+    Merge any duplicate pigeons created before the constraint existed into
+    the oldest one. Messages that the oldest pigeon already has for a user are
+    dropped from the duplicates.
+    """
+    Pigeon = apps.get_model('pigeonpost', 'Pigeon')
+    Outbox = apps.get_model('pigeonpost', 'Outbox')
+    kept = {}
+    for pigeon in Pigeon.objects.order_by('id').iterator():
+        if pigeon.source_id:
+            key = (pigeon.source_content_type_id, pigeon.source_id)
+        elif pigeon.to_send:
+            key = (pigeon.source_content_type_id, None)
+        else:
+            continue
+        key += (pigeon.render_email_method, pigeon.send_to_id or 0, pigeon.send_to_method or '')
+        original = kept.setdefault(key, pigeon)
+        if original is pigeon:
+            continue
+        users = list(Outbox.objects.filter(pigeon=original).values_list('user_id', flat=True))
+        Outbox.objects.filter(pigeon=pigeon).exclude(user_id__in=users).update(pigeon=original)
+        Outbox.objects.filter(pigeon=pigeon).delete()
+        original.successes += pigeon.successes
+        original.failures += pigeon.failures
+        if pigeon.to_send and (not original.to_send or pigeon.scheduled_for < original.scheduled_for):
+            original.scheduled_for = pigeon.scheduled_for
+        original.to_send = original.to_send or pigeon.to_send
+        original.save()
+        pigeon.delete()
+
+
+def create_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor not in ('postgresql', 'sqlite'):
+        return
+    merge_duplicate_pigeons(apps, schema_editor)
+    for name, definition in UNIQUE_INDEXES:
+        schema_editor.execute('CREATE UNIQUE INDEX %s ON %s %s' % (
+            schema_editor.quote_name(name), schema_editor.quote_name('pigeonpost_pigeon'), definition))
+
+
+def drop_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor not in ('postgresql', 'sqlite'):
+        return
+    for name, definition in UNIQUE_INDEXES:
+        schema_editor.execute('DROP INDEX %s' % schema_editor.quote_name(name))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pigeonpost', '0002_queue_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_indexes, drop_indexes),
+    ]
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+# process_outbox only picks messages whose next_attempt_at has passed. As in
+# 0002_queue_indexes, PostgreSQL gets a partial index over the undelivered
+# messages, which isn't limited by failures for the reasons given there, and
+# other backends a composite index. Like those indexes, it is built
+# CONCURRENTLY on PostgreSQL, so this migration isn't atomic either.
+PARTIAL_INDEX = '(next_attempt_at) WHERE NOT succeeded'
+INDEX = '(succeeded, next_attempt_at)'
+INDEX_NAME = 'pigeonpost_outbox_due'
+
+# Adding or removing a column rebuilds the table on SQLite, which loses the
+# index added in 0002_queue_indexes, so it is put back afterwards.
+PENDING_INDEX = 'CREATE INDEX IF NOT EXISTS pigeonpost_outbox_pending ON pigeonpost_outbox (succeeded, id)'
+
+
+def restore_pending_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute(PENDING_INDEX)
+
+
+def create_index(apps, schema_editor):
+    restore_pending_index(apps, schema_editor)
+    if schema_editor.connection.vendor == 'postgresql':
+        definition = PARTIAL_INDEX
+        create = 'CREATE INDEX CONCURRENTLY'
+    else:
+        definition = INDEX
+        create = 'CREATE INDEX'
+    schema_editor.execute('%s %s ON %s %s' % (
+        create, schema_editor.quote_name(INDEX_NAME), schema_editor.quote_name('pigeonpost_outbox'), definition))
+
+
+def drop_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'mysql':
+        schema_editor.execute('DROP INDEX %s ON %s' % (
+            schema_editor.quote_name(INDEX_NAME), schema_editor.quote_name('pigeonpost_outbox')))
+    elif schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute('DROP INDEX CONCURRENTLY %s' % schema_editor.quote_name(INDEX_NAME))
+    else:
+        schema_editor.execute('DROP INDEX %s' % schema_editor.quote_name(INDEX_NAME))
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('pigeonpost', '0003_unique_pigeons'),
+    ]
+
+    operations = [
+        migrations.RunPython(migrations.RunPython.noop, restore_pending_index),
+        # Existing messages are all due straight away
+        migrations.AddField(
+            model_name='outbox',
+            name='next_attempt_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, help_text=b'When the message is next due to be sent. Pushed back after each failure.'),
+        ),
+        migrations.RunPython(create_index, drop_index),
+    ]
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+# Adding columns rebuilds the table on SQLite, which loses the indexes added
+# with raw SQL in the earlier migrations, so they are put back afterwards.
+SQLITE_INDEXES = [
+    'CREATE INDEX IF NOT EXISTS pigeonpost_pigeon_due ON pigeonpost_pigeon (to_send, scheduled_for)',
+    'CREATE INDEX IF NOT EXISTS pigeonpost_outbox_pending ON pigeonpost_outbox (succeeded, id)',
+    'CREATE INDEX IF NOT EXISTS pigeonpost_outbox_due ON pigeonpost_outbox (succeeded, next_attempt_at)',
+    "CREATE UNIQUE INDEX IF NOT EXISTS pigeonpost_pigeon_source_uniq ON pigeonpost_pigeon "
+    "(source_content_type_id, source_id, render_email_method, "
+    "COALESCE(send_to_id, 0), COALESCE(send_to_method, '')) WHERE source_id IS NOT NULL",
+    "CREATE UNIQUE INDEX IF NOT EXISTS pigeonpost_pigeon_class_uniq ON pigeonpost_pigeon "
+    "(source_content_type_id, render_email_method, "
+    "COALESCE(send_to_id, 0), COALESCE(send_to_method, '')) WHERE source_id IS NULL AND to_send",
+]
+
+
+def restore_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        for sql in SQLITE_INDEXES:
+            schema_editor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pigeonpost', '0004_outbox_next_attempt_at'),
+    ]
+
+    operations = [
+        migrations.RunPython(migrations.RunPython.noop, restore_indexes),
+        migrations.AddField(
+            model_name='pigeon',
+            name='claimed_by',
+            field=models.CharField(help_text=b'The worker that is processing this pigeon, if PIGEONPOST_CLAIM_WORK is set.', max_length=100, null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='pigeon',
+            name='claimed_until',
+            field=models.DateTimeField(help_text=b"When the worker's claim on this pigeon expires.", null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='outbox',
+            name='claimed_by',
+            field=models.CharField(help_text=b'The worker that is sending this message, if PIGEONPOST_CLAIM_WORK is set.', max_length=100, null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='outbox',
+            name='claimed_until',
+            field=models.DateTimeField(help_text=b"When the worker's claim on this message expires.", null=True, blank=True),
+        ),
+        migrations.RunPython(restore_indexes, migrations.RunPython.noop),
+    ]
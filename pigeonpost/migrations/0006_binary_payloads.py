@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+import zlib
+import base64
+import pickle
+import logging
+
+from django.core.mail import EmailMessage, EmailMultiAlternatives
+from django.db import migrations, models
+from django.db.models import BinaryField, Case, TextField, Value, When
+
+logger = logging.getLogger('pigeonpost.migrations')
+
+# Outbox.message changes from a TextField holding base64 encoded pickles to
+# a BinaryField holding payloads in the format of pigeonpost.serializers. The
+# payloads are written to a new column, which then replaces the old one.
+#
+# The parts of the payload format that this needs are copied here, rather
+# than importing pigeonpost.serializers, so that the migration keeps working
+# however that changes, and doesn't depend on the project's settings. New
+# payloads always use the pickle codec, which can store any message.
+
+BATCH_SIZE = 500
+
+MAGIC = b'PP'
+VERSION = 1
+HEADER_SIZE = 5
+COMPRESSED = 1
+PICKLE = b'p'
+JSON = b'j'
+
+# Changing columns rebuilds the table on SQLite, which loses the indexes added
+# with raw SQL in the earlier migrations, so they are put back afterwards.
+SQLITE_INDEXES = [
+    'CREATE INDEX IF NOT EXISTS pigeonpost_outbox_pending ON pigeonpost_outbox (succeeded, id)',
+    'CREATE INDEX IF NOT EXISTS pigeonpost_outbox_due ON pigeonpost_outbox (succeeded, next_attempt_at)',
+]
+
+
+def restore_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        for sql in SQLITE_INDEXES:
+            schema_editor.execute(sql)
+
+
+def load_legacy(message):
+    """
+    Messages queued before this migration are base64 encoded protocol 2
+    pickles, except for add_to_outbox, which stored plain protocol 0 pickles.
+    """
+    message = message.encode('utf-8') if isinstance(message, unicode) else bytes(message)
+    # A protocol 2 pickle starts with \x80\x02, which is "gA" in base64
+    if message.startswith(b'gA'):
+        message = base64.b64decode(message)
+    return pickle.loads(message)
+
+
+def dump_payload(email):
+    data = pickle.dumps(email, 2)
+    flags = 0
+    compressed = zlib.compress(data)
+    if len(compressed) < len(data):
+        data = compressed
+        flags |= COMPRESSED
+    return MAGIC + chr(VERSION) + PICKLE + chr(flags) + data
+
+
+def _load_content(content):
+    if isinstance(content, dict):
+        if 'blob' in content:
+            raise ValueError("The message refers to blob %s" % content['blob'])
+        return base64.b64decode(content['base64'])
+    return content
+
+
+def _load_json(data):
+    fields = json.loads(data)
+    cls = {'EmailMessage': EmailMessage, 'EmailMultiAlternatives': EmailMultiAlternatives}[fields['class']]
+    email = cls(subject=fields['subject'], body=_load_content(fields['body']),
+            from_email=fields['from_email'], to=fields['to'], cc=fields['cc'],
+            bcc=fields['bcc'], reply_to=fields['reply_to'], headers=fields['headers'])
+    email.encoding = fields['encoding']
+    email.content_subtype = fields['content_subtype']
+    email.mixed_subtype = fields['mixed_subtype']
+    email.attachments = [(name, _load_content(content), mimetype)
+        for name, content, mimetype in fields['attachments']]
+    if 'alternatives' in fields:
+        email.alternative_subtype = fields['alternative_subtype']
+        email.alternatives = [(_load_content(content), mimetype)
+            for content, mimetype in fields['alternatives']]
+    return email
+
+
+def load_payload(payload):
+    """ Load a payload written with the pickle or json codec """
+    payload = bytes(payload)
+    if not payload.startswith(MAGIC):
+        return load_legacy(payload)
+    version, codec, flags = ord(payload[2]), payload[3], ord(payload[4])
+    if version != VERSION or codec not in (PICKLE, JSON):
+        raise ValueError("Can't load a payload with version %d and codec %r" % (version, codec))
+    data = payload[HEADER_SIZE:]
+    if flags & COMPRESSED:
+        data = zlib.decompress(data)
+    if codec == PICKLE:
+        return pickle.loads(data)
+    return _load_json(data)
+
+
+def _convert(apps, schema_editor, source, target, convert, keep, output_field):
+    """
+    Fill in the target column from the source column, a batch at a time.
+    Rows that can't be converted are logged and copied across with keep,
+    so that they fail when they are sent, as they would have before.
+    """
+    Outbox = apps.get_model('pigeonpost', 'Outbox')
+    ops = schema_editor.connection.ops
+    last_id = 0
+    while True:
+        rows = list(Outbox.objects.filter(id__gt=last_id).order_by('id')
+                .values_list('id', source)[:BATCH_SIZE])
+        if not rows:
+            return
+        converted = []
+        for pk, value in rows:
+            try:
+                converted.append((pk, convert(value)))
+            except Exception as err:
+                logger.warning("Couldn't convert Outbox message %d, copying it as it is: %r" % (pk, err))
+                converted.append((pk, keep(value)))
+        # Each row takes three parameters: its id in the WHEN, the value, and
+        # its id in the WHERE
+        batch_size = ops.bulk_batch_size(['id', 'value', 'id'], converted)
+        for i in range(0, len(converted), batch_size):
+            chunk = converted[i:i + batch_size]
+            Outbox.objects.filter(id__in=[pk for pk, value in chunk]).update(**{target: Case(
+                    *[When(id=pk, then=Value(value, output_field=output_field)) for pk, value in chunk],
+                    output_field=output_field)})
+        last_id = rows[-1][0]
+
+
+def serialize_payloads(apps, schema_editor):
+    # Payloads without the header are still loaded as legacy pickles
+    _convert(apps, schema_editor, 'message', 'payload',
+            lambda message: dump_payload(load_legacy(message)),
+            lambda message: message.encode('utf-8'),
+            BinaryField())
+
+
+def unserialize_payloads(apps, schema_editor):
+    _convert(apps, schema_editor, 'payload', 'message',
+            lambda payload: pickle.dumps(load_payload(payload), 2).encode('base64'),
+            lambda payload: base64.b64encode(bytes(payload)).decode('ascii'),
+            TextField())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pigeonpost', '0005_claims'),
+    ]
+
+    operations = [
+        migrations.RunPython(migrations.RunPython.noop, restore_indexes),
+        migrations.AddField(
+            model_name='outbox',
+            name='payload',
+            field=models.BinaryField(null=True),
+        ),
+        # Nullable, so that the old column can be added back and filled in if
+        # this is reversed
+        migrations.AlterField(
+            model_name='outbox',
+            name='message',
+            field=models.TextField(null=True),
+        ),
+        migrations.RunPython(serialize_payloads, unserialize_payloads),
+        migrations.RemoveField(
+            model_name='outbox',
+            name='message',
+        ),
+        migrations.RenameField(
+            model_name='outbox',
+            old_name='payload',
+            new_name='message',
+        ),
+        migrations.AlterField(
+            model_name='outbox',
+            name='message',
+            field=models.BinaryField(help_text=b'The EmailMessage, as serialised by pigeonpost.serializers.'),
+        ),
+        migrations.RunPython(restore_indexes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+import zlib
+import base64
+import logging
+
+import django.utils.timezone
+from django.db import migrations, models
+from django.db.models import BinaryField, Case, Value, When
+
+logger = logging.getLogger('pigeonpost.migrations')
+
+BATCH_SIZE = 500
+
+# The parts of the pigeonpost.serializers payload format that inline_blobs
+# needs, copied here so that the migration doesn't change along with it.
+# Only the json codec refers to blobs.
+MAGIC = b'PP'
+VERSION = 1
+HEADER_SIZE = 5
+COMPRESSED = 1
+JSON = b'j'
+
+
+def _inline_content(content, blobs):
+    if isinstance(content, dict) and 'blob' in content:
+        data = bytes(blobs[content['blob']])
+        if content.get('binary'):
+            return {'base64': base64.b64encode(data)}
+        return data.decode('utf-8')
+    return content
+
+
+def inline_payload(payload, blobs):
+    """ Returns the payload with the blobs it refers to put back into it """
+    payload = bytes(payload)
+    if payload[:4] != MAGIC + chr(VERSION) + JSON:
+        raise ValueError("Not a json payload")
+    flags = ord(payload[4])
+    data = payload[HEADER_SIZE:]
+    if flags & COMPRESSED:
+        data = zlib.decompress(data)
+    fields = json.loads(data)
+    fields['body'] = _inline_content(fields['body'], blobs)
+    fields['attachments'] = [(name, _inline_content(content, blobs), mimetype)
+        for name, content, mimetype in fields['attachments']]
+    if 'alternatives' in fields:
+        fields['alternatives'] = [(_inline_content(content, blobs), mimetype)
+            for content, mimetype in fields['alternatives']]
+    data = json.dumps(fields, separators=(',', ':'))
+    if flags & COMPRESSED:
+        data = zlib.compress(data)
+    return MAGIC + chr(VERSION) + JSON + chr(flags) + data
+
+
+def inline_blobs(apps, schema_editor):
+    """
+    Put the blobs back into the payloads of the messages that refer to them.
+    Messages that can't be inlined are logged and left as they are.
+    """
+    Outbox = apps.get_model('pigeonpost', 'Outbox')
+    Blob = apps.get_model('pigeonpost', 'Blob')
+    ops = schema_editor.connection.ops
+    linked = Outbox.objects.filter(blobs__isnull=False).distinct().order_by('id')
+    last_id = 0
+    while True:
+        rows = list(linked.filter(id__gt=last_id).values_list('id', 'message')[:BATCH_SIZE])
+        if not rows:
+            return
+        ids = [pk for pk, message in rows]
+        blobs = dict(Blob.objects.filter(outboxes__in=ids).values_list('hash', 'data'))
+        inlined = []
+        for pk, message in rows:
+            try:
+                inlined.append((pk, inline_payload(message, blobs)))
+            except Exception as err:
+                logger.warning("Couldn't put the blobs back into Outbox message %d: %r" % (pk, err))
+        last_id = rows[-1][0]
+        if not inlined:
+            continue
+        # Each row takes three parameters: its id in the WHEN, the value, and
+        # its id in the WHERE
+        batch_size = ops.bulk_batch_size(['id', 'value', 'id'], inlined)
+        for i in range(0, len(inlined), batch_size):
+            chunk = inlined[i:i + batch_size]
+            Outbox.objects.filter(id__in=[pk for pk, message in chunk]).update(message=Case(
+                    *[When(id=pk, then=Value(message, output_field=BinaryField())) for pk, message in chunk],
+                    output_field=BinaryField()))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pigeonpost', '0006_binary_payloads'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Blob',
+            fields=[
+                ('hash', models.CharField(help_text=b'The SHA-256 of the data, in hex.', max_length=64, serialize=False, primary_key=True)),
+                ('data', models.BinaryField()),
+                ('stored_at', models.DateTimeField(default=django.utils.timezone.now, help_text=b'When the blob was last stored. Unreferenced blobs are only deleted once this is old enough.')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='outbox',
+            name='blobs',
+            field=models.ManyToManyField(help_text=b'The blobs that the message refers to, if PIGEONPOST_BLOB_MIN_SIZE is set.', related_name='outboxes', to='pigeonpost.Blob', blank=True),
+        ),
+        migrations.RunPython(migrations.RunPython.noop, inline_blobs),
+    ]
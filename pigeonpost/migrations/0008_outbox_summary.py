@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pigeonpost', '0007_blobs'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboxSummary',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('pruned', models.IntegerField(default=0, help_text=b'Number of sent messages that have been deleted.')),
+                ('first_sent_at', models.DateTimeField(null=True, blank=True)),
+                ('last_sent_at', models.DateTimeField(null=True, blank=True)),
+                ('pigeon', models.OneToOneField(related_name='outbox_summary', null=True, blank=True, to='pigeonpost.Pigeon', help_text=b'The pigeon the messages were for, or empty for messages added with add_to_outbox.', on_delete=django.db.models.deletion.CASCADE)),
+            ],
+            options={
+                'verbose_name_plural': 'outbox summaries',
+            },
+        ),
+    ]
@@ -2,6 +2,7 @@ from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.db import models
+from django.utils.timezone import now
 
 class Pigeon(models.Model):
     """ A pigeon is a message that will be delivered to a number of users """
@@ -30,20 +31,59 @@ class Pigeon(models.Model):
     scheduled_for = models.DateTimeField(
             help_text="The datetime when emails should be sent. Defaults to ASAP.")
 
+    claimed_by = models.CharField(max_length=100, null=True, blank=True,
+            help_text="The worker that is processing this pigeon, if PIGEONPOST_CLAIM_WORK is set.")
+    claimed_until = models.DateTimeField(null=True, blank=True,
+            help_text="When the worker's claim on this pigeon expires.")
+
     class Meta:
         ordering = ['scheduled_for']
 
 
+class Blob(models.Model):
+    """
+    A message part, such as a body or an attachment, stored once and shared
+    by every Outbox message that includes it.
+    """
+    hash = models.CharField(max_length=64, primary_key=True,
+            help_text="The SHA-256 of the data, in hex.")
+    data = models.BinaryField()
+    stored_at = models.DateTimeField(default=now,
+            help_text="When the blob was last stored. Unreferenced blobs are only deleted once this is old enough.")
+
+
 class Outbox(models.Model):
     pigeon = models.ForeignKey(Pigeon, null=True, blank=True)
     user = models.ForeignKey(User)
-    message = models.TextField()
+    message = models.BinaryField(
+            help_text="The EmailMessage, as serialised by pigeonpost.serializers.")
     sent_at = models.DateTimeField(null=True, blank=True)
     succeeded = models.BooleanField(default=False)
     failures = models.IntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=now,
+            help_text="When the message is next due to be sent. Pushed back after each failure.")
+    claimed_by = models.CharField(max_length=100, null=True, blank=True,
+            help_text="The worker that is sending this message, if PIGEONPOST_CLAIM_WORK is set.")
+    claimed_until = models.DateTimeField(null=True, blank=True,
+            help_text="When the worker's claim on this message expires.")
+    blobs = models.ManyToManyField(Blob, blank=True, related_name='outboxes',
+            help_text="The blobs that the message refers to, if PIGEONPOST_BLOB_MIN_SIZE is set.")
 
     class Meta:
         unique_together = ('pigeon', 'user')
         ordering = ['sent_at']
         verbose_name_plural = 'outboxes'
 
+
+
+class OutboxSummary(models.Model):
+    """ What is left of a pigeon's Outbox messages once they have been pruned """
+    pigeon = models.OneToOneField(Pigeon, null=True, blank=True, related_name='outbox_summary',
+            help_text="The pigeon the messages were for, or empty for messages added with add_to_outbox.")
+    pruned = models.IntegerField(default=0,
+            help_text="Number of sent messages that have been deleted.")
+    first_sent_at = models.DateTimeField(null=True, blank=True)
+    last_sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name_plural = 'outbox summaries'
@@ -0,0 +1,210 @@
+import os
+import copy
+import pickle
+import logging
+from collections import deque
+from itertools import islice
+from multiprocessing.dummy import DummyProcess
+from multiprocessing.pool import Pool, ThreadPool
+
+from django.conf import settings
+from django.core.mail import EmailMessage
+from django.db import connections
+
+from pigeonpost import serializers
+
+logger = logging.getLogger('pigeonpost.render')
+
+
+def encode_email(email, blobs=None):
+    """
+    Serialise an EmailMessage for storing in the Outbox. If ``blobs`` is a
+    dict, large parts of the message are added to it, see pigeonpost.blobs.
+    """
+    return serializers.dumps(email, blobs=blobs)
+
+def chunked(iterable, size):
+    """ Split an iterable into lists of at most size items """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def render_chunk(args):
+    """
+    Render and serialise the messages for a list of users.
+
+    If the source has a ``<render_email_method>_bulk`` method, it is called
+    once with the whole list and should yield (user, email) pairs. Otherwise
+    render_email_method is called for each user.
+
+    Returns a list of (user, email, encoded, blobs) tuples, where encoded is
+    None if no EmailMessage was rendered for that user, and blobs is a dict of
+    the blobs that encoded refers to. This is run by the render workers, so
+    must not write to the database.
+    """
+    source, render_email_method, users = args
+    render_emails = getattr(source, render_email_method + '_bulk', None)
+    if render_emails is None:
+        render_email = getattr(source, render_email_method)
+        render_emails = lambda users: ((user, render_email(user)) for user in users)
+    use_blobs = bool(getattr(settings, 'PIGEONPOST_BLOB_MIN_SIZE', 0))
+    # Messages in the chunk share the data of their common blobs, so it is
+    # only sent back from a render process once
+    chunk_blobs = {}
+    rendered = []
+    for user, email in render_emails(users):
+        if email and isinstance(email, EmailMessage):
+            blobs = {} if use_blobs else None
+            encoded = encode_email(email, blobs)
+            if blobs:
+                blobs = dict((key, chunk_blobs.setdefault(key, data)) for key, data in blobs.items())
+            rendered.append((user, email, encoded, blobs or {}))
+        else:
+            rendered.append((user, email, None, {}))
+    return rendered
+
+def _init_render_process():
+    """
+    Forked render processes inherit the parent's database connections. Drop
+    them, without closing them on the server, so each process connects anew.
+    """
+    for conn in connections.all():
+        if conn.connection is not None:
+            try:
+                os.close(conn.connection.fileno())
+            except (AttributeError, OSError):
+                pass
+            conn.connection = None
+
+
+class _RenderThread(DummyProcess):
+    """
+    A render pool thread. Django opens a database connection for each thread
+    that uses one, so close them as the thread finishes, once the pool is
+    shut down, rather than leaving them for the server to time out.
+    """
+
+    def run(self):
+        try:
+            DummyProcess.run(self)
+        finally:
+            connections.close_all()
+
+
+class _RenderThreadPool(ThreadPool):
+    Process = _RenderThread
+
+
+class RenderPool(object):
+    """
+    A pool of workers that render and serialise messages in parallel.
+
+    ``mode`` is either 'thread' or 'process'. Processes avoid the GIL, but need
+    to be sent the pigeon's source, so sources that can't be pickled are
+    rendered with threads instead.
+    """
+
+    def __init__(self, workers, mode='thread'):
+        self.workers = workers
+        self.mode = mode
+        self._pools = {}
+
+    @classmethod
+    def from_settings(cls):
+        """ Returns a RenderPool if PIGEONPOST_RENDER_WORKERS is set, otherwise None """
+        workers = getattr(settings, 'PIGEONPOST_RENDER_WORKERS', 0)
+        if not workers:
+            return None
+        return cls(workers, getattr(settings, 'PIGEONPOST_RENDER_POOL', 'thread'))
+
+    def _pool(self, mode):
+        if mode not in self._pools:
+            if mode == 'process':
+                self._pools[mode] = Pool(self.workers, initializer=_init_render_process)
+            else:
+                self._pools[mode] = _RenderThreadPool(self.workers)
+        return self._pools[mode]
+
+    def pool_for(self, source):
+        if self.mode == 'process':
+            try:
+                pickle.dumps(source, 2)
+                return self._pool('process')
+            except (pickle.PicklingError, TypeError, AttributeError):
+                logger.debug("Can't pickle %r for the render processes, using threads" % source)
+        return self._pool('thread')
+
+    def map(self, source, tasks):
+        """
+        Run render_chunk over tasks, yielding the results in order. Only a
+        few tasks are in flight at once, so tasks can be a lazy iterator.
+        """
+        pool = self.pool_for(source)
+        pending = deque()
+        for task in tasks:
+            pending.append(pool.apply_async(render_chunk, (task,)))
+            if len(pending) >= 2 * self.workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+    def close(self):
+        for pool in self._pools.values():
+            pool.terminate()
+            pool.join()
+        self._pools = {}
+
+
+def render_copies(render_email, users):
+    """
+    Render one message and yield a copy of it addressed to each user, as
+    render_chunk would. Users are rendered in turn until one gets a message,
+    so only the users that render_email returns nothing for are skipped. The
+    copies only go to their user, so the message's cc and bcc are dropped.
+    """
+    use_blobs = bool(getattr(settings, 'PIGEONPOST_BLOB_MIN_SIZE', 0))
+    template = None
+    for user in users:
+        if template is None:
+            email = render_email(user)
+            if not (email and isinstance(email, EmailMessage)):
+                yield user, email, None, {}
+                continue
+            template = email
+        email = copy.copy(template)
+        email.to = [user.email]
+        email.cc = []
+        email.bcc = []
+        blobs = {} if use_blobs else None
+        yield user, email, encode_email(email, blobs), blobs or {}
+
+def render_messages(source, render_email_method, users, render_pool=None):
+    """
+    Yields a (user, email, encoded, blobs) tuple for each rendered user, in
+    order.
+
+    The users are rendered in chunks of PIGEONPOST_RENDER_CHUNK, or
+    PIGEONPOST_BULK_CHUNK for sources with a bulk render method, in parallel
+    if a RenderPool is given. If the render method is marked with
+    utils.user_agnostic, it is only called once.
+    """
+    render_email = getattr(source, render_email_method, None)
+    if getattr(render_email, 'user_agnostic', False):
+        for result in render_copies(render_email, users):
+            yield result
+        return
+    if hasattr(source, render_email_method + '_bulk'):
+        chunk_size = getattr(settings, 'PIGEONPOST_BULK_CHUNK', 500)
+    else:
+        chunk_size = getattr(settings, 'PIGEONPOST_RENDER_CHUNK', 50)
+    tasks = ((source, render_email_method, chunk) for chunk in chunked(users, chunk_size))
+    if render_pool is None:
+        results = (render_chunk(task) for task in tasks)
+    else:
+        results = render_pool.map(source, tasks)
+    for rendered in results:
+        for result in rendered:
+            yield result
@@ -0,0 +1,395 @@
+import time
+import logging
+import smtplib
+import threading
+from collections import OrderedDict, deque
+from Queue import Queue, Empty
+
+from django.conf import settings
+from django.core import mail
+from django.core.mail.backends import smtp as smtp_backend
+from django.core.mail.message import sanitize_address
+
+send_logger = logging.getLogger('pigeonpost.send')
+
+CONNECTION_ERRORS = (smtplib.SMTPException, smtplib.socket.error)
+
+
+class ConnectionUnavailable(Exception):
+    """ The mail server couldn't be connected to, so there is no point trying more messages """
+
+
+def _is_disconnect(err):
+    """ Whether an error means the server has dropped, or is closing, the connection """
+    if isinstance(err, (smtplib.SMTPServerDisconnected, smtplib.socket.error)):
+        return True
+    # 421 is "Service not available, closing transmission channel"
+    return isinstance(err, smtplib.SMTPResponseException) and err.smtp_code == 421
+
+
+class ManagedConnection(object):
+    """
+    A mail connection that is opened once and reused for many messages.
+
+    If the server drops the connection, it is reopened and the message is
+    resent once. The connection is also reopened after
+    PIGEONPOST_MAX_MESSAGES_PER_CONNECTION messages, to stay within the
+    relay's limits, and kept alive with a NOOP if it has been idle for
+    PIGEONPOST_SMTP_KEEPALIVE seconds. It has the same send_messages and
+    close methods as a mail backend.
+    """
+
+    def __init__(self):
+        self.max_messages = getattr(settings, 'PIGEONPOST_MAX_MESSAGES_PER_CONNECTION', None)
+        self.keepalive_interval = getattr(settings, 'PIGEONPOST_SMTP_KEEPALIVE', 60)
+        self.connect_attempts = getattr(settings, 'PIGEONPOST_SMTP_CONNECT_ATTEMPTS', 3)
+        self.connection = None
+        self.sent = 0
+        self.last_used = None
+
+    def open(self):
+        """
+        Open a new connection, trying a few times before raising
+        ConnectionUnavailable.
+        """
+        self.close()
+        for attempt in range(self.connect_attempts):
+            try:
+                connection = mail.get_connection()
+                if hasattr(connection, 'open'):
+                    connection.open()
+            except CONNECTION_ERRORS as err:
+                send_logger.warning("Couldn't connect to the mail server: %s" % err)
+                if attempt + 1 < self.connect_attempts:
+                    time.sleep(2 ** attempt)
+                continue
+            self.connection = connection
+            self.sent = 0
+            self.last_used = time.time()
+            return
+        raise ConnectionUnavailable("Couldn't connect to the mail server after %d attempts" %
+                self.connect_attempts)
+
+    def close(self):
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except CONNECTION_ERRORS:
+                pass
+            self.connection = None
+
+    def send_messages(self, email_messages):
+        return self._send(lambda: self.connection.send_messages(email_messages), len(email_messages))
+
+    def sendmail(self, email):
+        """
+        Send an EmailMessage, returning the recipients that the server
+        refused. Django's SMTP backend only raises if every recipient is
+        refused, so with it the message is sent over the SMTP connection
+        directly. Other backends are expected to raise if the message isn't
+        delivered, so nothing is refused.
+        """
+        return self._send(lambda: self._sendmail(email), 1)
+
+    def _sendmail(self, email):
+        smtp = getattr(self.connection, 'connection', None)
+        if not isinstance(self.connection, smtp_backend.EmailBackend) or smtp is None:
+            self.connection.send_messages([email])
+            return []
+        encoding = email.encoding or settings.DEFAULT_CHARSET
+        recipients = OrderedDict((sanitize_address(addr, encoding), addr) for addr in email.recipients())
+        refused = smtp.sendmail(sanitize_address(email.from_email, encoding), list(recipients),
+                email.message().as_bytes(linesep='\r\n'))
+        return [recipients[addr] for addr in refused]
+
+    def _send(self, send, count):
+        """ Call send, reconnecting and trying again once if the connection has dropped """
+        if self.connection is None or (self.max_messages and self.sent >= self.max_messages):
+            self.open()
+        try:
+            result = send()
+        except CONNECTION_ERRORS as err:
+            if not _is_disconnect(err):
+                raise
+            send_logger.warning("Lost the connection to the mail server (%s), reconnecting" % err)
+            self.open()
+            result = send()
+        self.sent += count
+        self.last_used = time.time()
+        return result
+
+    def keepalive(self):
+        """
+        Send a NOOP if the connection has been idle for a while, so the server
+        doesn't time it out. If that fails, the connection is reopened when
+        the next message is sent.
+        """
+        if self.connection is None or time.time() - self.last_used < self.keepalive_interval:
+            return
+        # Django's SMTP backend keeps the smtplib.SMTP instance as .connection
+        smtp = getattr(self.connection, 'connection', None)
+        if smtp is None:
+            return
+        try:
+            code = smtp.noop()[0]
+        except CONNECTION_ERRORS:
+            code = None
+        if code == 250:
+            self.last_used = time.time()
+        else:
+            self.close()
+
+
+def send_message(connection, email):
+    """
+    Send an EmailMessage with a mail connection, returning whether it was
+    sent. SMTP and socket errors are logged rather than raised.
+    """
+    try:
+        connection.send_messages([email])
+        send_logger.debug("Message sent!")
+        return True
+    except (smtplib.SMTPException, smtplib.socket.error) as err:
+        send_logger.debug("Message failed!")
+        if type(err) == smtplib.SMTPRecipientsRefused and email.to:
+            send_logger.error("Failed sending mail to %s" % ','.join(email.to))
+        send_logger.exception(err.args[0])
+        return False
+
+def send_fanout(connection, email):
+    """
+    Send an EmailMessage to several recipients at once with a
+    ManagedConnection, returning the set of recipients it was delivered to.
+    SMTP and socket errors are logged rather than raised.
+    """
+    try:
+        refused = connection.sendmail(email)
+    except (smtplib.SMTPException, smtplib.socket.error) as err:
+        send_logger.debug("Message failed!")
+        send_logger.exception(err.args[0])
+        return set()
+    if refused:
+        send_logger.error("Failed sending mail to %s" % ','.join(refused))
+    send_logger.debug("Message sent!")
+    return set(email.recipients()) - set(refused)
+
+
+class ConcurrentSender(object):
+    """
+    Sends messages over several mail connections at once.
+
+    Each worker thread owns a ManagedConnection, and takes messages from
+    a bounded queue, so only a few messages are waiting to be sent at any
+    time. Results are collected for the calling thread, which is responsible
+    for writing them to the database. If a worker can't connect to the mail
+    server, the messages it is given are returned with a result of None, and
+    ``unavailable`` is set.
+
+    Messages are sent with send_message, or the ``send`` function they are
+    submitted with, such as send_fanout, and the result is what that returns.
+
+    If ``routed`` is set, each worker has its own queue, and messages
+    submitted with the same ``route`` always go to the same worker, and so
+    over the same connection.
+    """
+
+    def __init__(self, workers, routed=False):
+        if routed:
+            self.queues = [Queue(maxsize=2) for i in range(workers)]
+        else:
+            self.queues = [Queue(maxsize=2 * workers)] * workers
+        self._results = Queue()
+        self.unavailable = False
+        self.threads = [threading.Thread(target=self._work, args=(queue,)) for queue in self.queues]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def _work(self, tasks):
+        connection = ManagedConnection()
+        try:
+            while True:
+                try:
+                    task = tasks.get(timeout=connection.keepalive_interval)
+                except Empty:
+                    connection.keepalive()
+                    continue
+                if task is None:
+                    break
+                key, email, send = task
+                if self.unavailable:
+                    self._results.put((key, None))
+                    continue
+                try:
+                    succeeded = send(connection, email)
+                except ConnectionUnavailable as err:
+                    send_logger.error(err)
+                    self.unavailable = True
+                    succeeded = None
+                except Exception as err:
+                    # Keep the worker alive, so the queue keeps draining
+                    send_logger.exception(err)
+                    succeeded = False
+                self._results.put((key, succeeded))
+        finally:
+            connection.close()
+
+    def submit(self, key, email, route=None, send=send_message):
+        """ Queue an email to be sent, blocking while the queue is full """
+        if route is None:
+            tasks = self.queues[0]
+        else:
+            tasks = self.queues[hash(route) % len(self.queues)]
+        tasks.put((key, email, send))
+
+    def results(self):
+        """ Yields the (key, result) of the messages sent so far """
+        while True:
+            try:
+                yield self._results.get_nowait()
+            except Empty:
+                return
+
+    def close(self):
+        """ Wait for the queued messages to be sent, and stop the workers """
+        for tasks in self.queues:
+            tasks.put(None)
+        for thread in self.threads:
+            thread.join()
+
+
+class TokenBucket(object):
+    """
+    Allows up to ``burst`` sends at once, refilling at ``rate`` sends per
+    second. A rate of None never runs out.
+    """
+
+    def __init__(self, rate, burst, clock=time.time):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.clock = clock
+        self.updated = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self):
+        """ Use up a token, returning False if there are none left """
+        if self.rate is None:
+            return True
+        self._refill()
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def wait(self):
+        """ The number of seconds until the next token is available """
+        if self.rate is None:
+            return 0
+        self._refill()
+        return max(0, (1 - self.tokens) / float(self.rate))
+
+
+class DomainScheduler(object):
+    """
+    Reorders messages so that recipient domains take turns, one message each,
+    and limits the rate each domain is sent to with a TokenBucket.
+
+    Messages are read ahead up to ``window`` at a time. Once a domain runs out
+    of tokens, and no other domain can be sent to, the scheduler waits for the
+    next token for up to ``max_wait`` seconds (PIGEONPOST_DOMAIN_MAX_WAIT,
+    default 60), so a slow domain is sent to at its rate for the whole run.
+    Only domains that would need a longer wait, i.e. with a rate of less than
+    one message per ``max_wait`` seconds, are deferred: the rest of their
+    messages are skipped for this run, and left as they are in the Outbox to
+    be sent next time. If ``stop`` (a threading.Event) is given, it is waited
+    on instead of sleeping, so that setting it cuts a wait short.
+    """
+
+    def __init__(self, rate=None, burst=10, rates=None, max_wait=60, window=500,
+            clock=time.time, sleep=time.sleep, stop=None):
+        self.rate = rate
+        self.burst = burst
+        self.rates = rates or {}
+        self.max_wait = max_wait
+        self.window = window
+        self.clock = clock
+        self.sleep = sleep
+        self.stop = stop
+        self.buckets = {}
+        self.deferred = {}
+
+    @classmethod
+    def from_settings(cls, window=500, stop=None):
+        """ A scheduler for the PIGEONPOST_DOMAIN_* settings, or None if there are no limits """
+        rate = getattr(settings, 'PIGEONPOST_DOMAIN_RATE', None)
+        rates = getattr(settings, 'PIGEONPOST_DOMAIN_RATES', None)
+        if rate is None and not rates:
+            return None
+        return cls(rate=rate, rates=rates, window=window, stop=stop,
+                burst=getattr(settings, 'PIGEONPOST_DOMAIN_BURST', 10),
+                max_wait=getattr(settings, 'PIGEONPOST_DOMAIN_MAX_WAIT', 60))
+
+    def bucket(self, domain):
+        if domain not in self.buckets:
+            rate, burst = self.rates.get(domain, (self.rate, self.burst))
+            self.buckets[domain] = TokenBucket(rate, burst, clock=self.clock)
+        return self.buckets[domain]
+
+    def _defer(self, domain, count=1):
+        self.deferred[domain] = self.deferred.get(domain, 0) + count
+
+    def schedule(self, items, domain_of):
+        """ Yields ``items`` in a fair order, skipping those for deferred domains """
+        items = iter(items)
+        pending = OrderedDict()
+        buffered = 0
+        exhausted = False
+        while True:
+            while not exhausted and buffered < self.window:
+                try:
+                    item = next(items)
+                except StopIteration:
+                    exhausted = True
+                    break
+                domain = domain_of(item)
+                if domain in self.deferred:
+                    self._defer(domain)
+                    continue
+                pending.setdefault(domain, deque()).append(item)
+                buffered += 1
+            if not pending:
+                break
+            sent = False
+            for domain in list(pending):
+                if not self.bucket(domain).take():
+                    continue
+                queue = pending[domain]
+                yield queue.popleft()
+                buffered -= 1
+                sent = True
+                if not queue:
+                    del pending[domain]
+            if sent:
+                continue
+            # Every domain is out of tokens
+            waits = dict((domain, self.bucket(domain).wait()) for domain in pending)
+            for domain, wait in waits.items():
+                if wait > self.max_wait:
+                    buffered -= len(pending[domain])
+                    self._defer(domain, len(pending.pop(domain)))
+            if not pending:
+                continue
+            wait = min(waits[domain] for domain in pending)
+            if self.stop is None:
+                self.sleep(wait)
+            elif self.stop.wait(wait):
+                # Stopped while waiting, so leave the rest for the next run
+                break
+        if self.deferred:
+            send_logger.info("Deferred %d messages for throttled domains: %s" % (
+                sum(self.deferred.values()), ', '.join(sorted(self.deferred))))
@@ -0,0 +1,302 @@
+"""
+Serialisation of EmailMessages for storing in the Outbox.
+
+Every payload starts with a short header: the magic bytes ``PP``, the format
+version, the id of the codec that encoded the message, and a flags byte that
+says whether the rest is zlib compressed. Payloads without the header are
+from older versions of pigeonpost, and are base64 encoded (or plain) pickles.
+
+Three codecs are built in:
+
+* ``json`` stores the fields of an EmailMessage or EmailMultiAlternatives as
+  JSON, so loading a message never unpickles anything. Messages it can't
+  represent, such as other EmailMessage subclasses or MIME attachments, are
+  stored with the pickle codec instead. Given a dict of blobs, bodies and
+  attachments of at least PIGEONPOST_BLOB_MIN_SIZE bytes are moved into it,
+  keyed by their SHA-256, and the payload only refers to them.
+* ``pickle`` stores any EmailMessage, as a binary pickle.
+* ``mime`` renders the message to MIME once, and stores the bytes along with
+  the envelope. It loads as a RawEmailMessage, which hands the bytes to the
+  mail backend as they are.
+
+PIGEONPOST_SERIALIZER chooses the codec (default ``'json'``), and
+PIGEONPOST_COMPRESS whether to compress payloads (default ``True``). Other
+codecs can be added with register().
+"""
+import json
+import zlib
+import pickle
+import base64
+import hashlib
+
+from django.conf import settings
+from django.core.mail import EmailMessage, EmailMultiAlternatives
+from django.utils.encoding import force_text
+
+MAGIC = b'PP'
+VERSION = 1
+HEADER_SIZE = 5
+COMPRESSED = 1
+
+# Payloads shorter than this don't shrink enough to be worth compressing
+COMPRESS_MIN_SIZE = 256
+
+
+class SerializationError(Exception):
+    """ A payload couldn't be encoded or decoded """
+
+
+class PickleCodec(object):
+    name = 'pickle'
+    id = b'p'
+
+    def can_encode(self, email):
+        return True
+
+    def dumps(self, email):
+        return pickle.dumps(email, 2)
+
+    def loads(self, data):
+        return pickle.loads(data)
+
+
+class JSONCodec(object):
+    name = 'json'
+    id = b'j'
+    # dumps() and loads() take a dict of blobs
+    uses_blobs = True
+
+    classes = {
+        'EmailMessage': EmailMessage,
+        'EmailMultiAlternatives': EmailMultiAlternatives,
+    }
+
+    def can_encode(self, email):
+        if type(email) not in self.classes.values():
+            return False
+        # Attachments can also be MIMEBase instances, which only pickle can store
+        return all(isinstance(attachment, tuple) for attachment in email.attachments)
+
+    def dumps(self, email, blobs=None):
+        min_size = getattr(settings, 'PIGEONPOST_BLOB_MIN_SIZE', 0) if blobs is not None else 0
+        dump_content = lambda content: _dump_content(content, blobs, min_size)
+        fields = {
+            'class': type(email).__name__,
+            'subject': email.subject,
+            'body': dump_content(email.body),
+            'from_email': email.from_email,
+            'to': email.to,
+            'cc': email.cc,
+            'bcc': email.bcc,
+            'reply_to': email.reply_to,
+            'headers': email.extra_headers,
+            'encoding': email.encoding,
+            'content_subtype': email.content_subtype,
+            'mixed_subtype': email.mixed_subtype,
+            'attachments': [(name, dump_content(content), mimetype)
+                for name, content, mimetype in email.attachments],
+        }
+        if isinstance(email, EmailMultiAlternatives):
+            fields['alternative_subtype'] = email.alternative_subtype
+            fields['alternatives'] = [(dump_content(content), mimetype)
+                for content, mimetype in email.alternatives]
+        return json.dumps(fields, separators=(',', ':'))
+
+    def loads(self, data, blobs=None):
+        fields = json.loads(data)
+        load_content = lambda content: _load_content(content, blobs)
+        email = self.classes[fields['class']](subject=fields['subject'], body=load_content(fields['body']),
+                from_email=fields['from_email'], to=fields['to'], cc=fields['cc'],
+                bcc=fields['bcc'], reply_to=fields['reply_to'], headers=fields['headers'])
+        email.encoding = fields['encoding']
+        email.content_subtype = fields['content_subtype']
+        email.mixed_subtype = fields['mixed_subtype']
+        email.attachments = [(name, load_content(content), mimetype)
+            for name, content, mimetype in fields['attachments']]
+        if 'alternatives' in fields:
+            email.alternative_subtype = fields['alternative_subtype']
+            email.alternatives = [(load_content(content), mimetype)
+                for content, mimetype in fields['alternatives']]
+        return email
+
+
+class RawMessage(object):
+    """ Stands in for the MIME message of a RawEmailMessage """
+
+    def __init__(self, data):
+        self.data = data
+
+    def as_bytes(self, unixfrom=False, linesep='\n'):
+        # smtplib turns the line endings into CRLF when sending, whatever
+        # linesep the backend asks for
+        return self.data
+    as_string = as_bytes
+
+    def __str__(self):
+        return self.data
+
+
+class RawEmailMessage(EmailMessage):
+    """
+    An email that has already been rendered to MIME bytes.
+
+    Only the envelope (from_email and the recipients, kept in ``to``) is
+    separate from the bytes, so rerouting the message, e.g. to
+    PIGEONPOST_SINK_EMAIL, changes who receives it but not its headers.
+    """
+
+    def __init__(self, data, from_email, recipients, subject=''):
+        super(RawEmailMessage, self).__init__(subject=subject, from_email=from_email, to=recipients)
+        self.data = data
+
+    def message(self):
+        return RawMessage(self.data)
+
+
+class MIMECodec(object):
+    name = 'mime'
+    id = b'm'
+
+    def can_encode(self, email):
+        return True
+
+    def dumps(self, email):
+        if isinstance(email, RawEmailMessage):
+            data = email.data
+        else:
+            data = email.message().as_bytes()
+        envelope = json.dumps({
+            'from_email': email.from_email,
+            'recipients': email.recipients(),
+            # Only kept for logging, the Subject header is in the data
+            'subject': force_text(email.subject),
+        }, separators=(',', ':'))
+        return envelope + b'\n' + data
+
+    def loads(self, data):
+        envelope, data = data.split(b'\n', 1)
+        envelope = json.loads(envelope)
+        return RawEmailMessage(data, envelope['from_email'], envelope['recipients'], envelope['subject'])
+
+
+def _dump_content(content, blobs=None, min_size=0):
+    """
+    Text is stored as it is, and bytes that aren't UTF-8 as base64. With
+    ``min_size``, content at least that long is put in ``blobs`` instead.
+    """
+    binary = False
+    if isinstance(content, bytes):
+        try:
+            content = content.decode('utf-8')
+        except UnicodeDecodeError:
+            binary = True
+    if min_size and isinstance(content, (bytes, unicode)):
+        data = content if binary else content.encode('utf-8')
+        if len(data) >= min_size:
+            key = hashlib.sha256(data).hexdigest()
+            blobs.setdefault(key, data)
+            return {'blob': key, 'binary': True} if binary else {'blob': key}
+    if binary:
+        return {'base64': base64.b64encode(content)}
+    return content
+
+def _load_content(content, blobs=None):
+    if isinstance(content, dict):
+        if 'blob' in content:
+            if blobs is None:
+                raise SerializationError("The message refers to blob %s, but no blobs were given" % content['blob'])
+            try:
+                data = blobs[content['blob']]
+            except KeyError:
+                raise SerializationError("Missing blob %s" % content['blob'])
+            return bytes(data) if content.get('binary') else bytes(data).decode('utf-8')
+        return base64.b64decode(content['base64'])
+    return content
+
+
+registry = {}
+
+def register(codec):
+    """ Make a codec available for PIGEONPOST_SERIALIZER and for loading payloads """
+    registry[codec.name] = registry[codec.id] = codec
+
+register(PickleCodec())
+register(JSONCodec())
+register(MIMECodec())
+
+
+def dumps(email, codec=None, compress=None, blobs=None):
+    """
+    Serialise an EmailMessage into a payload for the Outbox. If ``blobs`` is
+    a dict and PIGEONPOST_BLOB_MIN_SIZE is set, large parts of the message
+    are added to it rather than to the payload.
+    """
+    if codec is None:
+        codec = getattr(settings, 'PIGEONPOST_SERIALIZER', 'json')
+    if compress is None:
+        compress = getattr(settings, 'PIGEONPOST_COMPRESS', True)
+    codec = registry[codec]
+    data = None
+    if codec.can_encode(email):
+        try:
+            if getattr(codec, 'uses_blobs', False):
+                # Only keep the blobs if the codec succeeds
+                parts = {} if blobs is not None else None
+                data = codec.dumps(email, parts)
+                if parts:
+                    blobs.update(parts)
+            else:
+                data = codec.dumps(email)
+        except (TypeError, ValueError):
+            # e.g. lazy translations, or bytes that aren't UTF-8, in a header
+            pass
+    if data is None:
+        codec = registry['pickle']
+        data = codec.dumps(email)
+    flags = 0
+    if compress and len(data) >= COMPRESS_MIN_SIZE:
+        compressed = zlib.compress(data)
+        if len(compressed) < len(data):
+            data = compressed
+            flags |= COMPRESSED
+    return MAGIC + chr(VERSION) + codec.id + chr(flags) + data
+
+def loads(payload, blobs=None):
+    """
+    Load an EmailMessage from an Outbox payload, in any format. ``blobs``
+    maps the hashes of blobs to their data, and defaults to loading them
+    from the Blob table.
+    """
+    if isinstance(payload, unicode):
+        # A legacy payload read from the old text column
+        payload = payload.encode('utf-8')
+    # Binary columns come back as buffers or memoryviews, depending on the database
+    payload = bytes(payload)
+    if not payload.startswith(MAGIC):
+        return _loads_legacy(payload)
+    version, codec_id, flags = ord(payload[2]), payload[3], ord(payload[4])
+    if version != VERSION:
+        raise SerializationError("Unknown payload version %d" % version)
+    if codec_id not in registry:
+        raise SerializationError("Unknown codec %r" % codec_id)
+    data = payload[HEADER_SIZE:]
+    if flags & COMPRESSED:
+        data = zlib.decompress(data)
+    codec = registry[codec_id]
+    if getattr(codec, 'uses_blobs', False):
+        if blobs is None:
+            from pigeonpost.blobs import BlobCache
+            blobs = BlobCache()
+        return codec.loads(data, blobs)
+    return codec.loads(data)
+
+def _loads_legacy(payload):
+    """
+    Messages queued by older versions are base64 encoded protocol 2 pickles,
+    except for add_to_outbox, which stored plain protocol 0 pickles.
+    """
+    # A protocol 2 pickle starts with \x80\x02, which is "gA" in base64. A
+    # plain pickle can't start with "g", which is the opcode for a memo lookup
+    if payload.startswith(b'gA'):
+        payload = base64.b64decode(payload)
+    return pickle.loads(payload)
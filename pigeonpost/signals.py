@@ -1,6 +1,6 @@
 from django.dispatch import Signal
 
-pigeonpost_queue = Signal(providing_args=['render_email_method', 'scheduled_for', 'defer_for', 'retry'])
+pigeonpost_queue = Signal(providing_args=['render_email_method', 'scheduled_for', 'defer_for', 'retry', 'immediate'])
 
 pigeonpost_pre_send = Signal()
 
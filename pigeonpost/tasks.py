@@ -1,21 +1,30 @@
+import copy
+import time
 import datetime
 import logging
 import smtplib
-import pickle
+import random
 import inspect
+import threading
+from Queue import Queue
+from collections import defaultdict, OrderedDict
 
 from django.core import mail
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.auth.models import User
 from django.dispatch import receiver
 from django.conf import settings
-from django.core.mail import EmailMessage
 from django.utils.timezone import now
-from django.db import models
+from django.db import models, connection, transaction, IntegrityError, close_old_connections
+from django.db.models import Q, Count, Min, Max
 
-from pigeonpost.models import Pigeon, Outbox
+from pigeonpost import asyncsmtp, blobs, claiming, serializers
+from pigeonpost.models import Pigeon, Outbox, OutboxSummary
 from pigeonpost.signals import pigeonpost_queue
 from pigeonpost.signals import pigeonpost_pre_send, pigeonpost_post_send
+from pigeonpost.rendering import RenderPool, chunked, render_messages
+from pigeonpost.sending import ConcurrentSender, ConnectionUnavailable, DomainScheduler, ManagedConnection, send_fanout, send_message
+from pigeonpost.utils import IdSet
 
 send_logger = logging.getLogger('pigeonpost.send')
 dryrun_logger = logging.getLogger('pigeonpost.dryrun')
@@ -28,137 +37,589 @@ def add_to_outbox(message, user):
     the queue it's up to the caller to manage the message if something changes
     before the message is sent.
     """
-    msg = Outbox(message=pickle.dumps(message), user=user)
+    parts = {} if blobs.enabled() else None
+    msg = Outbox(message=serializers.dumps(message, blobs=parts), user=user)
+    if parts:
+        blobs.store(parts)
     msg.save()
+    if parts:
+        msg.blobs.add(*parts)
     return msg
 
-def unique(the_list):
+def unique(users):
     """ Used to remove duplicate users, but preserving send order """
-    seen = set()
-    for x in the_list:
-        if x in seen: continue
-        seen.add(x)
-        yield x
-
-def _get_source(pigeon):
-    if pigeon.source_content_type and not pigeon.source_id:
-        return pigeon.source_content_type.model_class()
+    seen = IdSet()
+    for user in users:
+        if user.pk in seen: continue
+        seen.add(user.pk)
+        yield user
+
+def active_users(chunk_size=None):
+    """
+    Iterate over all active users in primary key order, fetching them
+    from the database in chunks so that memory use stays flat.
+    """
+    chunk_size = chunk_size or _bulk_chunk_size()
+    last_pk = 0
+    while True:
+        chunk = list(User.objects.filter(is_active=True, pk__gt=last_pk).order_by('pk')[:chunk_size])
+        for user in chunk:
+            yield user
+        if len(chunk) < chunk_size:
+            break
+        last_pk = chunk[-1].pk
+
+def _load_sources(pigeons):
+    """
+    Fetch the source objects of many pigeons, with one query per content type.
+
+    Returns a dict mapping (content type id, source id) to the source object.
+    Sources that no longer exist are missing from the dict.
+    """
+    source_ids = defaultdict(set)
+    for pigeon in pigeons:
+        if pigeon.source_id:
+            source_ids[pigeon.source_content_type_id].add(pigeon.source_id)
+    sources = {}
+    for ct_id, ids in source_ids.items():
+        model = ContentType.objects.get_for_id(ct_id).model_class()
+        if model is None:
+            continue
+        for chunk in chunked(ids, _bulk_chunk_size()):
+            for pk, source in model._base_manager.in_bulk(chunk).items():
+                sources[(ct_id, pk)] = source
+    return sources
+
+def _get_source(pigeon, sources):
+    if not pigeon.source_id:
+        return ContentType.objects.get_for_id(pigeon.source_content_type_id).model_class()
     else:
-        return pigeon.source
+        return sources.get((pigeon.source_content_type_id, pigeon.source_id))
+
+
+def _bulk_chunk_size():
+    return getattr(settings, 'PIGEONPOST_BULK_CHUNK', 500)
 
+def _create_outboxes(outboxes, parts=None, stored_blobs=None):
+    """
+    Insert a batch of Outbox rows with a single query.
+
+    If another process has created some of the same (pigeon, user) rows in
+    the meantime, the unique_together constraint stops the batch, and we fall
+    back to inserting the rows one at a time, skipping the duplicates.
+
+    ``parts`` maps user ids to the blobs that their messages refer to, which
+    are stored first, skipping those in ``stored_blobs``, and then linked.
+    """
+    if not outboxes:
+        return
+    if parts:
+        all_parts = {}
+        for user_parts in parts.values():
+            all_parts.update(user_parts)
+        blobs.store(all_parts, stored_blobs)
+    try:
+        with transaction.atomic():
+            Outbox.objects.bulk_create(outboxes)
+    except IntegrityError:
+        for outbox in outboxes:
+            try:
+                with transaction.atomic():
+                    outbox.save()
+            except IntegrityError:
+                dryrun_logger.debug("Outbox for pigeon %d and user %d already exists" %
+                        (outbox.pigeon_id, outbox.user_id))
+    if parts:
+        ids = Outbox.objects.filter(pigeon_id=outboxes[0].pigeon_id,
+                user_id__in=list(parts)).values_list('user_id', 'id')
+        blobs.link(dict((pk, list(parts[user_id])) for user_id, pk in ids))
 
-def process_queue(force=False, dry_run=False):
+def process_queue(force=False, dry_run=False, stop=None, pigeon=None):
     """
     Takes pigeons from queue, adds messages to the outbox 
+
+    If ``stop`` (a threading.Event) is set, no more pigeons are started.
+    If ``pigeon`` is given, only that pigeon is processed, if it is due.
+    Returns the number of pigeons processed.
     """
     if force:
         pigeons = Pigeon.objects.filter(to_send=True)
     else:
         pigeons = Pigeon.objects.filter(scheduled_for__lte=now(), to_send=True)
-    for pigeon in pigeons:
-        the_source = _get_source(pigeon)
-        if the_source is None:
-            # Ensure the source object that the pigeon is related to still exists.
-            # If it doesn't, then we just mark the pigeon as processed and move on.
-            pigeon.to_send = False
-            pigeon.failures += 1
-            pigeon.save()
-            dryrun_logger.debug("Skipping Pigeon %d with missing %s source object" %
-                    (pigeon.id, str(pigeon.source_content_type)) )
-            continue
-        # Get method for rendering email for each user
-        render_email = getattr(the_source, pigeon.render_email_method)
-        # Get a list of users to potentially generated emails for
-        if pigeon.send_to:
-            users = [pigeon.send_to]
-        elif pigeon.send_to_method:
-            get_user_method = getattr(the_source, pigeon.send_to_method)
-            users = get_user_method()
+    # Ordering matches the pigeonpost_pigeon_due index
+    pigeons = pigeons.order_by('scheduled_for').select_related('send_to')
+    if pigeon is not None:
+        pigeons = pigeons.filter(id=pigeon.id)
+        # A single pigeon, e.g. one sent immediately, is rendered in this thread
+        render_pool = None
+    else:
+        render_pool = RenderPool.from_settings()
+    processed = 0
+    try:
+        if claiming.enabled() and not dry_run:
+            processed = _process_claimed_pigeons(pigeons, render_pool, stop)
         else:
-            users = User.objects.filter(is_active=True)
-        # prevent users getting duplicate emails if the get_user_method is naughty
-        # and adds a user twice
-        users = list(unique(users))
-
-        sink_limit = None
-        emails_generated = 0
-
-        if hasattr(settings, 'PIGEONPOST_SINK_EMAIL'):
-            send_logger.debug("Using sink email and a message for %d users, only sending first 5!" %
-                    len(users))
-            sink_limit = getattr(settings, 'PIGEONPOST_SINK_LIMIT', 5)
-
-        # Iterate through the users and try adding messages to the Outbox model
-        for user in users:
-            if sink_limit is not None and emails_generated > sink_limit: continue
-            email = render_email(user)
-            if dry_run:
-                try:
-                    message = '{0} CREATED [{0}])'.format(user.email, email.message().as_string().replace('\n', '\t'))
-                except AttributeError:
-                    message = '{0} PASS'.format(user.email)
-                dryrun_logger.debug(message)
-                continue
-            if email and isinstance(email, EmailMessage):
-                try:
-                    Outbox.objects.get(pigeon=pigeon, user=user)
-                except Outbox.DoesNotExist:
-                    pickled = pickle.dumps(email, 2)
-                    Outbox(pigeon=pigeon, user=user, message=pickled.encode('base64')).save()
-                pigeon.successes += 1
-                emails_generated += 1
+            pigeons = list(pigeons)
+            sources = _load_sources(pigeons)
+            for pigeon in _until_stopped(pigeons, stop):
+                _process_pigeon(pigeon, sources, dry_run=dry_run, render_pool=render_pool)
+                processed += 1
+    finally:
+        if render_pool is not None:
+            render_pool.close()
+    return processed
+
+def _process_claimed_pigeons(pigeons, render_pool, stop=None):
+    """
+    Claim pigeons one at a time and process them, so that several workers can
+    share the queue. Returns the number of pigeons processed.
+    """
+    claimer = claiming.Claimer()
+    processed = 0
+    try:
+        while not (stop and stop.is_set()):
+            ids = claimer.claim(pigeons, 1)
+            if not ids:
+                break
+            claimed = list(pigeons.filter(id__in=ids))
+            sources = _load_sources(claimed)
+            for pigeon in claimed:
+                _process_pigeon(pigeon, sources, render_pool=render_pool, claimer=claimer)
+                processed += 1
+            claimer.release(Pigeon, ids)
+    finally:
+        claimer.release(Pigeon)
+    return processed
+
+def _process_pigeon(pigeon, sources, dry_run=False, render_pool=None, claimer=None):
+    the_source = _get_source(pigeon, sources)
+    if the_source is None:
+        # Ensure the source object that the pigeon is related to still exists.
+        # If it doesn't, then we just mark the pigeon as processed and move on.
         pigeon.to_send = False
-        pigeon.sent_at = now()
+        pigeon.failures += 1
         pigeon.save()
+        dryrun_logger.debug("Skipping Pigeon %d with missing %s source object" %
+                (pigeon.id, str(pigeon.source_content_type)) )
+        return
+    # Get a list of users to potentially generated emails for
+    if pigeon.send_to:
+        users = [pigeon.send_to]
+    elif pigeon.send_to_method:
+        get_user_method = getattr(the_source, pigeon.send_to_method)
+        users = get_user_method()
+        if isinstance(users, models.QuerySet):
+            # Don't cache the whole result set in the queryset
+            users = users.iterator()
+    else:
+        users = active_users()
+    # prevent users getting duplicate emails if the get_user_method is naughty
+    # and adds a user twice
+    users = unique(users)
+
+    sink_limit = None
+    emails_generated = 0
+
+    if hasattr(settings, 'PIGEONPOST_SINK_EMAIL'):
+        send_logger.debug("Using sink email, only sending the first %d messages!" %
+                getattr(settings, 'PIGEONPOST_SINK_LIMIT', 5))
+        sink_limit = getattr(settings, 'PIGEONPOST_SINK_LIMIT', 5)
+
+    # Users that already have a message for this pigeon (e.g. when it is retried)
+    existing = IdSet(Outbox.objects.filter(pigeon=pigeon).values_list('user_id', flat=True).iterator())
+    chunk_size = _bulk_chunk_size()
+    outboxes = []
+    # The blobs of the messages in outboxes, and the hashes of those stored so far
+    parts = {}
+    stored_blobs = set()
+
+    # Render the email for each user and try adding messages to the Outbox model
+    rendered = render_messages(the_source, pigeon.render_email_method, users, render_pool)
+    for user, email, encoded, message_parts in rendered:
+        if sink_limit is not None and emails_generated > sink_limit: break
+        if dry_run:
+            try:
+                message = '{0} CREATED [{0}])'.format(user.email, email.message().as_string().replace('\n', '\t'))
+            except AttributeError:
+                message = '{0} PASS'.format(user.email)
+            dryrun_logger.debug(message)
+            continue
+        if encoded is not None:
+            if user.id not in existing:
+                existing.add(user.id)
+                outboxes.append(Outbox(pigeon=pigeon, user_id=user.id, message=encoded))
+                if message_parts:
+                    parts[user.id] = message_parts
+                if len(outboxes) >= chunk_size:
+                    _create_outboxes(outboxes, parts, stored_blobs)
+                    outboxes = []
+                    parts = {}
+                    if claimer is not None:
+                        claimer.renew(Pigeon, [pigeon.id])
+            pigeon.successes += 1
+            emails_generated += 1
+    _create_outboxes(outboxes, parts, stored_blobs)
+    pigeon.to_send = False
+    pigeon.sent_at = now()
+    pigeon.save()
 
-def process_outbox(max_retries=3, pigeon=None):
+def process_outbox(max_retries=3, pigeon=None, engine=None, stop=None):
     """
     Sends mail from Outbox.
+
+    Messages are sent over PIGEONPOST_SMTP_CONCURRENCY connections at once
+    (default 1). Each connection is reused for many messages, and reopened if
+    the server drops it. If the mail server can't be reached at all, sending
+    stops until the next run, without counting it against the messages.
+    A message that fails isn't retried until its next_attempt_at, which
+    backs off exponentially with each failure.
+
+    With engine='async' (or PIGEONPOST_OUTBOX_ENGINE = 'async'), messages are
+    sent over up to PIGEONPOST_ASYNC_CONNECTIONS non-blocking connections
+    driven by a single thread instead. See pigeonpost.asyncsmtp.
+
+    If PIGEONPOST_DOMAIN_RATE or PIGEONPOST_DOMAIN_RATES is set, recipient
+    domains take turns and are rate limited, see sending.DomainScheduler.
+    Messages for domains too slow to wait for (see PIGEONPOST_DOMAIN_MAX_WAIT)
+    are left for the next run.
+
+    If PIGEONPOST_CLAIM_WORK is set, messages are claimed a chunk at a time,
+    so that several workers can send from the Outbox at once.
+
+    If ``stop`` (a threading.Event) is set, the messages already handed to
+    the mail connections are sent and recorded, and the rest are left.
     """
-    query_params = dict(succeeded=False, failures__lt=max_retries)
+    query_params = dict(succeeded=False, failures__lt=max_retries, next_attempt_at__lte=now())
+    attempted = 0
     if pigeon:
         query_params['pigeon'] = pigeon
+    claimer = claiming.Claimer() if claiming.enabled() else None
+    engine = engine or getattr(settings, 'PIGEONPOST_OUTBOX_ENGINE', 'default')
     try:
-        connection = mail.get_connection()
         if settings.EMAIL_HOST:
             send_logger.debug("Sending pigeons via %s:%s " % (
                 settings.EMAIL_HOST, settings.EMAIL_PORT))
-        for msg in Outbox.objects.filter(**query_params):
-            email = pickle.loads(msg.message.decode('base64'))
-            pigeonpost_pre_send.send(email)
-            if hasattr(settings, 'PIGEONPOST_SINK_EMAIL'):
-                send_logger.debug("A message for %s, rerouting to %s!" %
-                        (email.to, settings.PIGEONPOST_SINK_EMAIL))
-                email.to = [settings.PIGEONPOST_SINK_EMAIL]
-                email.cc = []
-                email.bcc = []
-            else:
-                send_logger.debug("A message for %s to deliver!" % email.to)
-            try:
-                connection.send_messages([email])
-                send_logger.debug("Message sent!")
-                msg.succeeded = True
-                msg.sent_at = now()
-            except (smtplib.SMTPException, smtplib.socket.error) as err:
-                send_logger.debug("Message failed!")
-                if type(err) == smtplib.SMTPRecipientsRefused and email.to:
-                    send_logger.error("Failed sending mail to %s" % ','.join(email.to))
-                send_logger.exception(err.args[0])
-                msg.failures += 1
-            msg.save()
-            pigeonpost_post_send.send(email, successful=msg.succeeded)
+        # Ordering by id rather than the default sent_at, which is null for
+        # unsent messages, lets the database walk the pigeonpost_outbox_pending
+        # index, or use pigeonpost_outbox_due when most messages aren't due
+        # The payloads are left out of the query and loaded a chunk at a time,
+        # so that only a chunk or two of them is in memory at once
+        messages = Outbox.objects.filter(**query_params).order_by('id').defer('message')
+        route = None
+        scheduler = DomainScheduler.from_settings(window=_bulk_chunk_size(), stop=stop)
+        if scheduler is not None:
+            messages = messages.select_related('user')
+            route = _recipient_domain
+        if claimer is not None:
+            messages = _claimed_messages(messages, claimer)
+        else:
+            messages = _paginate(messages)
+        # The payloads are loaded before the scheduler, since loading reads a
+        # chunk ahead, and anything after the scheduler has to take each
+        # message as it is let through
+        blob_cache = blobs.BlobCache()
+        messages = _load_payloads(messages, blob_cache)
+        if scheduler is not None:
+            messages = scheduler.schedule(messages, _recipient_domain)
+        messages = _until_stopped(messages, stop)
+        if claimer is not None:
+            messages = _renewing_claims(messages, claimer)
+        concurrency = getattr(settings, 'PIGEONPOST_SMTP_CONCURRENCY', 1)
+        if engine == 'async' and not asyncsmtp.supported():
+            send_logger.warning("The async engine doesn't support TLS, using the default engine")
+            engine = 'default'
+        if engine == 'async':
+            attempted = _send_concurrently(messages, asyncsmtp.AsyncSender(), blob_cache=blob_cache,
+                    fanout=scheduler is None)
+        elif engine != 'default':
+            raise ValueError("Unknown outbox engine %r" % engine)
+        elif concurrency > 1:
+            attempted = _send_concurrently(messages, ConcurrentSender(concurrency, routed=route is not None),
+                    route, blob_cache, fanout=scheduler is None)
+        else:
+            attempted = _send_serially(messages, blob_cache, fanout=scheduler is None)
+    except ConnectionUnavailable as err:
+        send_logger.error("%s, giving up until the next run" % err)
     except (smtplib.SMTPException, smtplib.socket.error) as err:
         send_logger.exception(err.args[0])
+    finally:
+        if claimer is not None:
+            # Let other workers have anything that wasn't sent
+            claimer.release(Outbox)
+    return attempted
 
-@receiver(pigeonpost_queue)
-def add_to_queue(sender, 
-        render_email_method='render_email', 
-        send_to=None, 
-        send_to_method=None, 
-        scheduled_for=None, 
-        defer_for=None, 
-        retry=False,
-        **kwargs):
+def _until_stopped(items, stop):
+    """ Yield the items until the stop event is set """
+    for item in items:
+        if stop is not None and stop.is_set():
+            return
+        yield item
+
+def _claimed_messages(messages, claimer):
+    """ Claim Outbox messages a chunk at a time, and yield them """
+    chunk_size = _bulk_chunk_size()
+    while True:
+        ids = claimer.claim(messages, chunk_size)
+        if not ids:
+            return
+        for msg in messages.filter(id__in=ids):
+            yield msg
+
+def _renewing_claims(messages, claimer):
+    """
+    Keep the leases on the claimed messages from running out while they are
+    sent, however long the mail server or the domain rate limits take.
+    """
+    for msg in messages:
+        claimer.heartbeat(Outbox)
+        yield msg
+
+def _paginate(messages):
+    """
+    Yield the messages a chunk at a time, by id, so that a large outbox
+    is never loaded all at once.
+    """
+    chunk_size = _bulk_chunk_size()
+    last_id = 0
+    while True:
+        chunk = list(messages.filter(id__gt=last_id)[:chunk_size])
+        if not chunk:
+            return
+        for msg in chunk:
+            yield msg
+        last_id = chunk[-1].id
+
+def _load_payloads(messages, blob_cache=None):
+    """
+    Fill in the deferred message payloads, with one query per chunk, and
+    load any blobs they refer to into blob_cache.
+    """
+    for chunk in chunked(messages, _bulk_chunk_size()):
+        ids = [msg.id for msg in chunk]
+        payloads = dict(Outbox.objects.filter(id__in=ids).values_list('id', 'message'))
+        if blob_cache is not None and blobs.enabled():
+            blob_cache.prefetch(ids)
+        for msg in chunk:
+            if msg.id not in payloads:
+                # Deleted since the chunk was read
+                continue
+            msg.message = payloads[msg.id]
+            yield msg
+
+def _send_serially(messages, blob_cache=None, fanout=True):
+    """ Send the messages over one connection, returning how many were sent or failed """
+    connection = ManagedConnection()
+    results = _OutboxResults()
+    try:
+        for prepared, email in _prepare_emails(messages, blob_cache, fanout=fanout):
+            connection.keepalive()
+            results.record([(prepared, _send_function(prepared)(connection, email))])
+    finally:
+        connection.close()
+        results.flush()
+    return results.recorded
+
+def _send_concurrently(messages, sender, route=None, blob_cache=None, fanout=True):
+    """ Send the messages with a ConcurrentSender or AsyncSender, returning how many were sent or failed """
+    results = _OutboxResults()
+    try:
+        for prepared, email in _prepare_emails(messages, blob_cache, route, fanout):
+            if sender.unavailable:
+                raise ConnectionUnavailable("Couldn't connect to the mail server")
+            sender.submit(prepared, email, route(prepared[0][0]) if route else None,
+                    _send_function(prepared))
+            results.record(sender.results())
+    finally:
+        sender.close()
+        results.record(sender.results())
+        results.flush()
+    return results.recorded
+
+def _recipient_domain(msg):
+    """ The domain that an Outbox message is delivered to, going by its user """
+    return msg.user.email.rpartition('@')[2].lower()
+
+def _prepare_email(msg, blob_cache=None):
+    """ Load the EmailMessage for an Outbox message, ready for sending """
+    email = serializers.loads(msg.message, blob_cache)
+    pigeonpost_pre_send.send(email)
+    if hasattr(settings, 'PIGEONPOST_SINK_EMAIL'):
+        send_logger.debug("A message for %s, rerouting to %s!" %
+                (email.to, settings.PIGEONPOST_SINK_EMAIL))
+        email.to = [settings.PIGEONPOST_SINK_EMAIL]
+        email.cc = []
+        email.bcc = []
+    else:
+        send_logger.debug("A message for %s to deliver!" % email.to)
+    return email
+
+def _prepare_emails(messages, blob_cache=None, route=None, fanout=True):
+    """
+    Yields a list of (msg, email) pairs and the EmailMessage to send for them.
+
+    With PIGEONPOST_FANOUT_RCPT_BATCH, messages from the same pigeon that
+    only differ in their single ``to`` address, such as the copies made for a
+    utils.user_agnostic render method, are sent as one message, to up to that
+    many recipients at once, as Bcc. Messages are grouped within each chunk
+    of PIGEONPOST_BULK_CHUNK, and with the same ``route``. Grouping reads a
+    chunk ahead, so it is turned off with ``fanout=False``, e.g. when the
+    messages come from a DomainScheduler, which has to see each one sent
+    before letting the next through.
+    """
+    batch_size = getattr(settings, 'PIGEONPOST_FANOUT_RCPT_BATCH', 0)
+    if not fanout or batch_size < 2:
+        for msg in messages:
+            email = _prepare_email(msg, blob_cache)
+            yield [(msg, email)], email
+        return
+    for chunk in chunked(messages, _bulk_chunk_size()):
+        groups = OrderedDict()
+        for msg in chunk:
+            email = _prepare_email(msg, blob_cache)
+            key = _fanout_key(email)
+            if key is None:
+                yield [(msg, email)], email
+                continue
+            key = (msg.pigeon_id, route(msg) if route else None, key)
+            group = groups.setdefault(key, [])
+            group.append((msg, email))
+            if len(group) >= batch_size:
+                del groups[key]
+                yield group, _fanout_email(group)
+        for group in groups.values():
+            yield group, _fanout_email(group)
+
+def _fanout_key(email):
+    """
+    What an EmailMessage has in common with copies of it for other users,
+    or None if it can't be sent to them as one message.
+    """
+    if type(email) not in (mail.EmailMessage, mail.EmailMultiAlternatives):
+        return None
+    if len(email.to) != 1 or email.cc or email.bcc:
+        return None
+    key = (type(email), email.subject, email.body, email.from_email, tuple(email.reply_to),
+            tuple(sorted(email.extra_headers.items())), email.encoding, email.content_subtype,
+            tuple(email.attachments), tuple(getattr(email, 'alternatives', ())))
+    try:
+        hash(key)
+    except TypeError:
+        # e.g. a MIMEBase attachment
+        return None
+    return key
+
+def _fanout_email(group):
+    """ One message for a group of (msg, email) pairs, to all of their recipients """
+    first = group[0][1]
+    if len(group) == 1:
+        return first
+    email = copy.copy(first)
+    email.extra_headers = dict(first.extra_headers)
+    email.extra_headers['To'] = getattr(settings, 'PIGEONPOST_FANOUT_TO', 'undisclosed-recipients:;')
+    email.to = []
+    email.bcc = list(OrderedDict((msg_email.to[0], None) for msg, msg_email in group))
+    return email
+
+def _send_function(prepared):
+    """ send_fanout for an email sent for several messages, otherwise send_message """
+    return send_fanout if len(prepared) > 1 else send_message
+
+def _delivered(result, email):
+    """
+    Whether an email was delivered, given the result of send_message, or
+    the set of recipients that send_fanout delivered to.
+    """
+    if isinstance(result, set):
+        return email.to[0] in result
+    return result
+
+class _OutboxResults(object):
+    """
+    Collects the results of sending Outbox messages, and writes them to the
+    database in batches, once PIGEONPOST_RESULT_BATCH results have built up or
+    PIGEONPOST_RESULT_INTERVAL seconds have passed. Each batch only updates the
+    status columns, with a few UPDATE statements, rather than saving every
+    message along with its payload. pigeonpost_post_send is sent for each
+    message once its result has been written.
+    """
+
+    def __init__(self):
+        self.batch_size = getattr(settings, 'PIGEONPOST_RESULT_BATCH', 100)
+        self.interval = getattr(settings, 'PIGEONPOST_RESULT_INTERVAL', 5)
+        self.pending = []
+        self.flushed_at = time.time()
+        self.recorded = 0
+
+    def add(self, msg, email, succeeded):
+        if succeeded:
+            msg.succeeded = True
+            msg.sent_at = now()
+        else:
+            msg.failures += 1
+            msg.next_attempt_at = now() + _retry_delay(msg.failures)
+        self.pending.append((msg, email))
+        self.recorded += 1
+        self._flush_if_due()
+
+    def record(self, results):
+        """
+        Add the (prepared, result) results of sending emails, where prepared
+        is a list of (msg, email) pairs. Messages that weren't attempted have
+        a result of None, and are left as they are.
+        """
+        for prepared, result in results:
+            if result is not None:
+                for msg, email in prepared:
+                    self.add(msg, email, _delivered(result, email))
+        self._flush_if_due()
+
+    def _flush_if_due(self):
+        if len(self.pending) >= self.batch_size or time.time() - self.flushed_at >= self.interval:
+            self.flush()
+
+    def flush(self):
+        pending, self.pending = self.pending, []
+        self.flushed_at = time.time()
+        if not pending:
+            return
+        sent = [msg for msg, email in pending if msg.succeeded]
+        failed = [msg for msg, email in pending if not msg.succeeded]
+        # Each message takes three parameters: its id in the WHEN, the value,
+        # and its id in the WHERE
+        batch_size = connection.ops.bulk_batch_size(['id', 'value', 'id'], pending)
+        with transaction.atomic():
+            for chunk in chunked(sent, batch_size):
+                Outbox.objects.filter(id__in=[msg.id for msg in chunk]).update(
+                        succeeded=True, sent_at=_case(chunk, 'sent_at'))
+            for chunk in chunked(failed, batch_size):
+                Outbox.objects.filter(id__in=[msg.id for msg in chunk]).update(
+                        failures=models.F('failures') + 1,
+                        next_attempt_at=_case(chunk, 'next_attempt_at'))
+        for msg, email in pending:
+            pigeonpost_post_send.send(email, successful=msg.succeeded)
+
+def _case(messages, field):
+    """ A CASE expression giving each message's value of field, by id """
+    output_field = Outbox._meta.get_field(field)
+    return models.Case(
+            *[models.When(id=msg.id, then=models.Value(getattr(msg, field), output_field=output_field))
+              for msg in messages],
+            output_field=output_field)
+
+def _retry_delay(failures):
+    """
+    How long to wait before retrying a message that has failed this many
+    times. The delay doubles with each failure, starting at
+    PIGEONPOST_RETRY_BACKOFF seconds and capped at PIGEONPOST_RETRY_BACKOFF_MAX,
+    and is then picked at random from the upper half of that range, so that
+    messages that failed together aren't all retried together.
+    """
+    base = getattr(settings, 'PIGEONPOST_RETRY_BACKOFF', 300)
+    cap = getattr(settings, 'PIGEONPOST_RETRY_BACKOFF_MAX', 6 * 60 * 60)
+    delay = min(cap, base * 2 ** (failures - 1))
+    return datetime.timedelta(seconds=random.uniform(delay / 2.0, delay))
+
+def _scheduled_time(scheduled_for=None, defer_for=None):
     # Check that we don't define both scheduled_for and defer_for at the same time. That is silly.
     assert not (scheduled_for and defer_for)
     # Work out the scheduled delivery time if necessary
@@ -166,60 +627,433 @@ def add_to_queue(sender,
         scheduled_for = now() + datetime.timedelta(seconds=defer_for)
     elif scheduled_for is None:
         scheduled_for = now()
+    return scheduled_for
+
+def _pigeon_key(sender, render_email_method, send_to, send_to_method, content_types=None):
+    """
+    Returns the key that identifies a pigeon: a tuple of the content type id,
+    source id, render_email_method, send_to id and send_to_method.
+
+    content_types is an optional dict used to cache content types by model.
+    """
     # Check that either a model instance, or a model, is responsible for this pigeon
     if isinstance(sender, models.Model):
         sender_id = sender.id
-        ct = ContentType.objects.get_for_model(sender, for_concrete_model=False)
+        model = type(sender)
     elif inspect.isclass(sender) and issubclass(sender, models.Model):
         # sender_model
         sender_id = None
-        ct = ContentType.objects.get_for_model(sender, for_concrete_model=False)
+        model = sender
     else:
         raise Exception("Unknown sender type. Must be models.Model subclass or instance")
-    try:
-        if sender_id:
-            p = Pigeon.objects.get(source_content_type=ct,
-                    source_id=sender_id,
-                    render_email_method=render_email_method,
-                    send_to=send_to,
-                    send_to_method=send_to_method)
-            if retry:
-                p.to_send = True
-            if p.to_send:
-                # If the pigeon has not been sent yet, or to_send has been set to True,
-                # update the pigeon with whatever the new scheduled time is
-                p.scheduled_for = scheduled_for
-                p.save()
+    if content_types is None:
+        content_types = {}
+    if model not in content_types:
+        content_types[model] = ContentType.objects.get_for_model(model, for_concrete_model=False).id
+    send_to_id = send_to.pk if send_to else None
+    return (content_types[model], sender_id or None, render_email_method,
+            send_to_id, send_to_method or None)
+
+@receiver(pigeonpost_queue)
+def add_to_queue(sender, 
+        render_email_method='render_email', 
+        send_to=None, 
+        send_to_method=None, 
+        scheduled_for=None, 
+        defer_for=None, 
+        retry=False,
+        immediate=False,
+        **kwargs):
+    # Pigeons sent immediately aren't scheduled for later
+    assert not (immediate and (scheduled_for or defer_for))
+    scheduled_for = _scheduled_time(scheduled_for, defer_for)
+    key = _pigeon_key(sender, render_email_method, send_to, send_to_method)
+    immediate = (immediate or defer_for == 0) and getattr(settings, 'PIGEONPOST_IMMEDIATE', False)
+    if getattr(settings, 'PIGEONPOST_COALESCE_ON_COMMIT', False) and connection.in_atomic_block:
+        # The buffer submits it once it has written the pigeon
+        _commit_buffer().add(key, scheduled_for, retry, immediate)
+    else:
+        _enqueue({key: (scheduled_for, retry)})
+        if immediate:
+            # After the pigeon has been written, and only if the transaction commits
+            transaction.on_commit(lambda: immediate_worker.submit(key))
+
+class _ImmediateWorker(object):
+    """
+    A background thread that renders and sends pigeons queued with
+    immediate=True (or defer_for=0) as soon as they are committed, one at a
+    time, so the code that queued them doesn't wait.
+
+    It writes the same Pigeon and Outbox rows as deploy_pigeons, which stays
+    the safety net: if sending fails, or the process exits first, the pigeon
+    and its messages are picked up by the next run.
+    """
+
+    def __init__(self):
+        self.queue = Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def submit(self, key):
+        """ Send the pigeon with this key (see _pigeon_key) in the background """
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name='pigeonpost-immediate')
+                self.thread.daemon = True
+                self.thread.start()
+        self.queue.put(key)
+
+    def join(self):
+        """ Wait until the pigeons submitted so far have been sent """
+        self.queue.join()
+
+    def _run(self):
+        while True:
+            key = self.queue.get()
+            try:
+                _send_immediately(key)
+            except Exception:
+                send_logger.exception("Couldn't send pigeon %r immediately, leaving it for deploy_pigeons" % (key,))
+            finally:
+                # This thread has its own connection, which shouldn't be left open while idle
+                connection.close()
+                self.queue.task_done()
+
+immediate_worker = _ImmediateWorker()
+
+def _send_immediately(key):
+    content_type_id, source_id, render_email_method, send_to_id, send_to_method = key
+    pigeon = Pigeon.objects.filter(source_content_type_id=content_type_id, source_id=source_id,
+            render_email_method=render_email_method, send_to_id=send_to_id,
+            send_to_method=send_to_method, to_send=True, scheduled_for__lte=now()).first()
+    if pigeon is None:
+        # Already processed, e.g. by deploy_pigeons
+        return
+    # Under the same locks as deploy_pigeons, so the pigeon's messages aren't
+    # also sent by a run that is going on at the same time. If either lock is
+    # held, that run, or the next one, sends them instead.
+    _deploy_queue(pigeon=pigeon)
+    _deploy_outbox(pigeon=pigeon)
+
+class _SavepointMarker(object):
+    """
+    Registered with on_commit in the savepoint that pigeons were queued in.
+    Django drops it if the savepoint is rolled back, so it only runs if the
+    savepoint was kept.
+    """
+
+    def __init__(self):
+        self.ran = False
+
+    def __call__(self):
+        self.ran = True
+
+class _CommitBuffer(object):
+    """
+    Pigeons queued during a transaction, which are queued when the
+    transaction commits, or forgotten if it is rolled back.
+
+    There is one buffer for the outermost transaction. Each pigeon is recorded
+    with the marker for the savepoint it was queued in, and flush is kept
+    after the markers in the on_commit callbacks, so it only queues the
+    pigeons from savepoints that weren't rolled back. Pigeons to be sent
+    immediately are submitted to the immediate_worker once they are queued.
+    """
+
+    def __init__(self):
+        self.queued = []
+        self.markers = {}
+
+    def add(self, key, scheduled_for, retry, immediate=False):
+        savepoint_ids = tuple(connection.savepoint_ids)
+        marker = self.markers.get(savepoint_ids)
+        if marker is None or not self._is_registered(marker):
+            marker = self.markers[savepoint_ids] = _SavepointMarker()
+            transaction.on_commit(marker)
+        self.queued.append((marker, key, scheduled_for, retry, immediate))
+        # Registered outside any savepoint, so only dropped if the whole
+        # transaction is rolled back
+        connection.run_on_commit = [(sids, func) for sids, func in connection.run_on_commit
+                if func != self.flush]
+        connection.run_on_commit.append((set(), self.flush))
+
+    def flush(self):
+        pigeons = OrderedDict()
+        immediate = OrderedDict()
+        for marker, key, scheduled_for, retry, send_now in self.queued:
+            if marker.ran:
+                # The last scheduled_for wins, but a retry is not forgotten
+                retry = retry or pigeons.pop(key, (None, False))[1]
+                pigeons[key] = (scheduled_for, retry)
+                if send_now:
+                    immediate[key] = None
+        self.queued = []
+        self.markers = {}
+        _enqueue(pigeons)
+        for key in immediate:
+            immediate_worker.submit(key)
+
+    def is_pending(self):
+        """ Whether flush is still waiting for the transaction to commit """
+        return self._is_registered(self.flush)
+
+    def _is_registered(self, callback):
+        return any(func == callback for sids, func in connection.run_on_commit)
+
+_commit_buffers = threading.local()
+
+def _commit_buffer():
+    """
+    Returns the _CommitBuffer for the current transaction.
+    """
+    buffer = getattr(_commit_buffers, 'buffer', None)
+    if buffer is None or not buffer.is_pending():
+        buffer = _commit_buffers.buffer = _CommitBuffer()
+    return buffer
+
+def queue_many(senders,
+        render_email_method='render_email',
+        send_to=None,
+        send_to_method=None,
+        scheduled_for=None,
+        defer_for=None,
+        retry=False):
+    """
+    Queue pigeons for many senders at once, with the same options as the
+    pigeonpost_queue signal.
+
+    This is much faster than sending the signal for each sender, e.g. when
+    importing a lot of objects. Content types are looked up once per model,
+    senders that appear more than once get a single pigeon, and the pigeons
+    are created or rescheduled with a few bulk queries.
+    """
+    scheduled_for = _scheduled_time(scheduled_for, defer_for)
+    content_types = {}
+    pigeons = OrderedDict()
+    for sender in senders:
+        key = _pigeon_key(sender, render_email_method, send_to, send_to_method, content_types)
+        pigeons[key] = (scheduled_for, retry)
+    _enqueue(pigeons)
+
+def _enqueue(pigeons):
+    """
+    Create or reschedule pigeons. pigeons is a dict mapping pigeon keys (see
+    _pigeon_key) to a (scheduled_for, retry) tuple.
+
+    There is one pigeon per model instance (and render_email_method, send_to,
+    send_to_method). It is only rescheduled while it is unsent, unless retry
+    is set, in which case it is also marked to be sent again. Pigeons for a
+    model class are rescheduled while they are unsent, otherwise a new pigeon
+    is created.
+    """
+    if not pigeons:
+        return
+    if _supports_upsert(connection):
+        _upsert_pigeons(pigeons)
+    else:
+        _get_or_create_pigeons(pigeons)
+
+def _supports_upsert(connection):
+    """
+    Whether the database supports INSERT ... ON CONFLICT, and has the unique
+    indexes from migration 0003_unique_pigeons for it to conflict on.
+    """
+    if connection.vendor == 'postgresql':
+        return connection.pg_version >= 90500
+    if connection.vendor == 'sqlite':
+        import sqlite3
+        return sqlite3.sqlite_version_info >= (3, 24, 0)
+    return False
+
+UPSERT_SOURCE_PIGEONS = """
+    INSERT INTO pigeonpost_pigeon (source_content_type_id, source_id, render_email_method,
+        send_to_id, send_to_method, scheduled_for, to_send, successes, failures)
+    VALUES {values}
+    ON CONFLICT (source_content_type_id, source_id, render_email_method,
+        COALESCE(send_to_id, 0), COALESCE(send_to_method, ''))
+        WHERE source_id IS NOT NULL
+    DO UPDATE SET to_send = EXCLUDED.to_send, scheduled_for = EXCLUDED.scheduled_for
+        WHERE pigeonpost_pigeon.to_send OR %s
+"""
+
+UPSERT_CLASS_PIGEONS = """
+    INSERT INTO pigeonpost_pigeon (source_content_type_id, source_id, render_email_method,
+        send_to_id, send_to_method, scheduled_for, to_send, successes, failures)
+    VALUES {values}
+    ON CONFLICT (source_content_type_id, render_email_method,
+        COALESCE(send_to_id, 0), COALESCE(send_to_method, ''))
+        WHERE source_id IS NULL AND to_send
+    DO UPDATE SET scheduled_for = EXCLUDED.scheduled_for
+"""
+
+UPSERT_ROW = '(%s, %s, %s, %s, %s, %s, %s, 0, 0)'
+
+def _upsert_pigeons(pigeons):
+    """ Create or reschedule pigeons with multi-row INSERT ... ON CONFLICT statements """
+    scheduled_for_field = Pigeon._meta.get_field('scheduled_for')
+    statements = defaultdict(list)
+    for key, (scheduled_for, retry) in pigeons.items():
+        row = key + (scheduled_for_field.get_db_prep_value(scheduled_for, connection), True)
+        if key[1]:
+            statements[(UPSERT_SOURCE_PIGEONS, bool(retry))].append(row)
         else:
-            p = Pigeon.objects.get(source_content_type=ct,
-                    source_id=None,
-                    render_email_method=render_email_method,
-                    send_to=send_to,
-                    send_to_method=send_to_method, 
-                    to_send=True)
-            # If the pigeon has not been sent yet, or to_send has been set to True,
-            # update the pigeon with whatever the new scheduled time is
-            p.scheduled_for = scheduled_for
-            p.save()
-    except Pigeon.DoesNotExist:
-        # Create a new pigeon
-        p = Pigeon(source_id=sender_id, source_content_type=ct,
-                render_email_method=render_email_method,
-                scheduled_for=scheduled_for,
-                send_to=send_to,
-                send_to_method=send_to_method)
-        p.save()
+            statements[(UPSERT_CLASS_PIGEONS, None)].append(row)
+    with connection.cursor() as cursor:
+        for (sql, retry), rows in statements.items():
+            # Keep within the database's limit on query parameters
+            rows_per_statement = min(_bulk_chunk_size(),
+                    connection.ops.bulk_batch_size([None] * 8, rows))
+            for chunk in chunked(rows, rows_per_statement):
+                params = [param for values in chunk for param in values]
+                if retry is not None:
+                    params.append(retry)
+                cursor.execute(sql.format(values=', '.join([UPSERT_ROW] * len(chunk))), params)
+
+def _get_or_create_pigeons(pigeons):
+    """ Create or reschedule pigeons, for databases without upserts """
+    keys_by_ct = defaultdict(list)
+    for key in pigeons:
+        keys_by_ct[key[0]].append(key)
+    for ct_id, keys in keys_by_ct.items():
+        for chunk in chunked(keys, _bulk_chunk_size()):
+            source_ids = [key[1] for key in chunk if key[1]]
+            candidates = Q(source_id__in=source_ids)
+            if len(source_ids) < len(chunk):
+                candidates |= Q(source_id=None, to_send=True)
+            existing = {}
+            rows = Pigeon.objects.filter(candidates, source_content_type_id=ct_id).values_list(
+                    'id', 'source_id', 'render_email_method', 'send_to_id', 'send_to_method', 'to_send')
+            for pk, source_id, render_email_method, send_to_id, send_to_method, to_send in rows:
+                key = (ct_id, source_id, render_email_method, send_to_id, send_to_method or None)
+                existing.setdefault(key, (pk, to_send))
+            new_pigeons = []
+            reschedule = defaultdict(list)
+            for key in chunk:
+                scheduled_for, retry = pigeons[key]
+                if key not in existing:
+                    new_pigeons.append(key)
+                    continue
+                pk, to_send = existing[key]
+                if to_send or retry:
+                    # If the pigeon has not been sent yet, or it is being retried,
+                    # update the pigeon with whatever the new scheduled time is
+                    reschedule[scheduled_for].append(pk)
+            for scheduled_for, pks in reschedule.items():
+                Pigeon.objects.filter(id__in=pks).update(to_send=True, scheduled_for=scheduled_for)
+            _create_pigeons([(key, pigeons[key]) for key in new_pigeons])
+
+def _create_pigeons(pigeons):
+    """
+    Insert a batch of new pigeons. If any of them were created by another
+    process in the meantime, fall back to creating them one at a time.
+    """
+    try:
+        with transaction.atomic():
+            Pigeon.objects.bulk_create([_new_pigeon(key, scheduled_for)
+                for key, (scheduled_for, retry) in pigeons])
+    except IntegrityError:
+        for key, (scheduled_for, retry) in pigeons:
+            try:
+                with transaction.atomic():
+                    _new_pigeon(key, scheduled_for).save()
+            except IntegrityError:
+                _get_or_create_pigeons({key: (scheduled_for, retry)})
+
+def _new_pigeon(key, scheduled_for):
+    ct_id, source_id, render_email_method, send_to_id, send_to_method = key
+    return Pigeon(source_content_type_id=ct_id,
+            source_id=source_id,
+            render_email_method=render_email_method,
+            send_to_id=send_to_id,
+            send_to_method=send_to_method,
+            scheduled_for=scheduled_for)
 
 from pigeonpost.utils import single_instance
 
-@single_instance('pigeonpost')
-def deploy_pigeons(force=False, dry_run=False):
-    process_queue(force=force, dry_run=dry_run)
-    if not dry_run:
-        process_outbox()
+# The queue and the outbox have separate locks, so that rendering a large
+# pigeon doesn't hold up sending the messages that are already in the outbox.
+# If either phase is already running in another process, it is skipped.
+
+@single_instance('pigeonpost-queue', exit=False)
+def _deploy_queue(force=False, dry_run=False, stop=None, pigeon=None):
+    return process_queue(force=force, dry_run=dry_run, stop=stop, pigeon=pigeon)
+
+@single_instance('pigeonpost-outbox', exit=False)
+def _deploy_outbox(engine=None, stop=None, pigeon=None, max_retries=3):
+    return process_outbox(max_retries=max_retries, engine=engine, stop=stop, pigeon=pigeon)
+
+def deploy_pigeons(force=False, dry_run=False, engine=None, queue=True, outbox=True, stop=None,
+        max_retries=3):
+    """
+    Render the pigeons that are due into the outbox, and then send the
+    outbox. Either phase can be left out, e.g. to run them in separate
+    processes.
+
+    Returns the number of pigeons processed and Outbox messages sent or
+    failed, which is 0 if another process was already running both phases.
+    """
+    progress = 0
+    if queue:
+        progress += _deploy_queue(force=force, dry_run=dry_run, stop=stop) or 0
+    if outbox and not dry_run and not (stop and stop.is_set()):
+        progress += _deploy_outbox(engine=engine, stop=stop, max_retries=max_retries) or 0
+    return progress
 send_email = deploy_pigeons # Alias
 
-@single_instance('pigeonpost')
+# Never wait less than this between runs, even if something is already due
+MIN_POLL_INTERVAL = 1
+
+def run_pigeons(engine=None, queue=True, outbox=True, poll_interval=None, stop=None, max_retries=3):
+    """
+    Deploy pigeons over and over until ``stop`` (a threading.Event) is set.
+
+    After each run, wait until the next pigeon or Outbox message is due, but
+    no longer than ``poll_interval`` (default PIGEONPOST_POLL_INTERVAL, or
+    60) seconds, so that newly queued pigeons are picked up.
+    """
+    if poll_interval is None:
+        poll_interval = getattr(settings, 'PIGEONPOST_POLL_INTERVAL', 60)
+    if stop is None:
+        stop = threading.Event()
+    while not stop.is_set():
+        close_old_connections()
+        progress = deploy_pigeons(engine=engine, queue=queue, outbox=outbox, stop=stop,
+                max_retries=max_retries)
+        if stop.is_set():
+            break
+        stop.wait(_seconds_until_due(poll_interval, queue, outbox, max_retries, progress))
+
+def _seconds_until_due(poll_interval, queue=True, outbox=True, max_retries=3, progress=True):
+    """
+    How long until the next pigeon or Outbox message is due, up to
+    poll_interval. Rows claimed by another worker are left out, as that
+    worker is handling them.
+
+    If the last run made no progress, anything that is already due is
+    something it couldn't send, such as messages held back by
+    PIGEONPOST_DOMAIN_RATE or for an unreachable mail server, so only rows
+    that become due later are waited for.
+    """
+    current = now()
+    unclaimed = Q(claimed_until__isnull=True) | Q(claimed_until__lt=current)
+    # Both of these use the pigeonpost_*_due indexes
+    pigeons = Pigeon.objects.filter(unclaimed, to_send=True)
+    messages = Outbox.objects.filter(unclaimed, succeeded=False, failures__lt=max_retries)
+    if not progress:
+        pigeons = pigeons.filter(scheduled_for__gt=current)
+        messages = messages.filter(next_attempt_at__gt=current)
+    due = []
+    if queue:
+        due.append(pigeons.aggregate(due=Min('scheduled_for'))['due'])
+    if outbox:
+        due.append(messages.aggregate(due=Min('next_attempt_at'))['due'])
+    due = [d for d in due if d is not None]
+    if not due:
+        return poll_interval
+    wait = (min(due) - current).total_seconds()
+    return max(MIN_POLL_INTERVAL, min(wait, poll_interval))
+
+@single_instance('pigeonpost-queue')
 def kill_pigeons():
     """
     Mark all unsent pigeons in the queue as send=False, so that they won't
@@ -229,3 +1063,60 @@ def kill_pigeons():
         pigeon.to_send = False
         pigeon.save()
 
+@single_instance('pigeonpost-prune', exit=False)
+def prune_pigeons(days=None, strip_only=None, summary=None, batch_size=None):
+    """
+    Delete the Outbox messages that were sent more than ``days`` ago
+    (default PIGEONPOST_RETENTION_DAYS, or 30), PIGEONPOST_PRUNE_BATCH at a
+    time, and then the blobs that they were the last to use.
+
+    With ``strip_only`` (default PIGEONPOST_PRUNE_STRIP_ONLY), the messages
+    are kept but their payloads are emptied, so that a pigeon queued again
+    still won't be sent to the same users. Otherwise, with ``summary``
+    (default PIGEONPOST_PRUNE_SUMMARY, or True), each pigeon's OutboxSummary
+    records how many of its messages were deleted, and when they were sent.
+
+    Only sent messages are pruned, and deploy_pigeons never changes those,
+    so it is safe to run at the same time. Returns the number of messages
+    pruned and the number of blobs deleted.
+    """
+    if days is None:
+        days = getattr(settings, 'PIGEONPOST_RETENTION_DAYS', 30)
+    if strip_only is None:
+        strip_only = getattr(settings, 'PIGEONPOST_PRUNE_STRIP_ONLY', False)
+    if summary is None:
+        summary = getattr(settings, 'PIGEONPOST_PRUNE_SUMMARY', True)
+    if batch_size is None:
+        batch_size = getattr(settings, 'PIGEONPOST_PRUNE_BATCH', 500)
+    old = Outbox.objects.filter(succeeded=True, sent_at__lt=now() - datetime.timedelta(days=days))
+    if strip_only:
+        old = old.exclude(message=b'')
+    pruned = 0
+    last_id = 0
+    while True:
+        # Each batch is a short transaction of its own, so locks aren't held for long
+        ids = list(old.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:batch_size])
+        if not ids:
+            break
+        with transaction.atomic():
+            Outbox.blobs.through.objects.filter(outbox_id__in=ids).delete()
+            if strip_only:
+                pruned += Outbox.objects.filter(id__in=ids).update(message=b'')
+            else:
+                if summary:
+                    _summarise(ids)
+                pruned += Outbox.objects.filter(id__in=ids).delete()[1].get(Outbox._meta.label, 0)
+        last_id = ids[-1]
+    return pruned, blobs.collect_garbage()
+
+def _summarise(ids):
+    """ Add the Outbox messages with these ids to their pigeons' summaries """
+    groups = (Outbox.objects.filter(id__in=ids).order_by().values('pigeon_id')
+            .annotate(count=Count('id'), first_sent_at=Min('sent_at'), last_sent_at=Max('sent_at')))
+    for group in groups:
+        summary = (OutboxSummary.objects.filter(pigeon_id=group['pigeon_id']).first() or
+                OutboxSummary(pigeon_id=group['pigeon_id']))
+        summary.pruned += group['count']
+        summary.first_sent_at = min(filter(None, [summary.first_sent_at, group['first_sent_at']]))
+        summary.last_sent_at = max(filter(None, [summary.last_sent_at, group['last_sent_at']]))
+        summary.save()
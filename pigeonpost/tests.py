@@ -1,4 +1,13 @@
+import os
+import pickle
 import datetime
+import smtplib
+import smtpd
+import socket
+import asyncore
+import threading
+from StringIO import StringIO
+from multiprocessing.pool import ThreadPool
 
 from django.conf import settings
 settings.EMAIL_BACKEND = 'django.core.mail.backends.locmem.EmailBackend'
@@ -7,13 +16,23 @@ settings.AUTH_PROFILE_MODULE = 'pigeonpost_example.Profile'
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
 from django.core import mail
-from django.test import TestCase
-from django.test.utils import override_settings
+from django.core.mail import EmailMessage, EmailMultiAlternatives
+from django.core.management import call_command
+from django.db import connection, connections, transaction
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import override_settings, CaptureQueriesContext
+from django.utils.timezone import now
 
-from pigeonpost.models import Pigeon, Outbox
-from pigeonpost_example.models import ModeratedNews, News, Profile, BobsNews, AggregateNews
-from pigeonpost.tasks import send_email, kill_pigeons, process_queue
-from pigeonpost.signals import pigeonpost_queue
+from pigeonpost import blobs, tasks, serializers
+from pigeonpost.claiming import Claimer
+from pigeonpost.models import Blob, Pigeon, Outbox, OutboxSummary
+from pigeonpost_example.models import ModeratedNews, News, Profile, BobsNews, AggregateNews, Announcement
+from pigeonpost.tasks import send_email, kill_pigeons, process_queue, queue_many, active_users, unique
+from pigeonpost.tasks import prune_pigeons, run_pigeons, _create_outboxes, _load_sources, _get_source
+from pigeonpost.utils import IdSet, user_agnostic
+from pigeonpost.rendering import RenderPool, render_copies
+from pigeonpost.sending import DomainScheduler, TokenBucket
+from pigeonpost.signals import pigeonpost_queue, pigeonpost_pre_send, pigeonpost_post_send
 
 def create_fixtures(create_message=True):
     # Set up test users
@@ -182,6 +201,13 @@ class FakeSMTPConnection:
     def close(*aa, **kwaa):
         return True
 
+class FailingSMTPConnection:
+    def send_messages(*msgs, **meh):
+        raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+
+    def close(*aa, **kwaa):
+        return True
+
 class TestFaultyConnection(TestCase):
     def setUp(self):
         self.users, self.staff, self.message, self.pigeon = create_fixtures()
@@ -201,6 +227,39 @@ class TestFaultyConnection(TestCase):
             assert(ob.pigeon.failures > 0)
         
 
+class TestRetryBackoff(TestCase):
+
+    def setUp(self):
+        self.users, self.staff, self.message, self.pigeon = create_fixtures()
+        process_queue(force=True)
+        self._get_conn = mail.get_connection
+        mail.get_connection = lambda *aa, **kw: FailingSMTPConnection()
+
+    def tearDown(self):
+        mail.get_connection = self._get_conn
+
+    @override_settings(PIGEONPOST_RETRY_BACKOFF=60)
+    def test_backoff(self):
+        """ Failed messages aren't retried until their next attempt is due """
+        send_email()
+        self.assertEqual(Outbox.objects.filter(failures=1).count(), 2)
+        for ob in Outbox.objects.all():
+            delay = ob.next_attempt_at - now()
+            self.assertTrue(datetime.timedelta(seconds=29) < delay <= datetime.timedelta(seconds=60))
+        send_email()
+        self.assertEqual(set(Outbox.objects.values_list('failures', flat=True)), set([1]))
+        Outbox.objects.update(next_attempt_at=now())
+        send_email()
+        for ob in Outbox.objects.all():
+            self.assertEqual(ob.failures, 2)
+            delay = ob.next_attempt_at - now()
+            self.assertTrue(datetime.timedelta(seconds=59) < delay <= datetime.timedelta(seconds=120))
+
+    @override_settings(PIGEONPOST_RETRY_BACKOFF=60, PIGEONPOST_RETRY_BACKOFF_MAX=90)
+    def test_backoff_max(self):
+        self.assertTrue(tasks._retry_delay(10) <= datetime.timedelta(seconds=90))
+
+
 class TestImmediateMessage(TestCase):
     def setUp(self):
         self.users, self.staff, _, _ = create_fixtures(create_message=False)
@@ -305,3 +364,1285 @@ class TestUnboundPigeons(TestCase):
         messages = Outbox.objects.all()
         self.assertEqual(len(messages),2)
         self.assertEqual(messages[1].user, self.bob)
+
+
+class TestBulkOutbox(TestCase):
+
+    def setUp(self):
+        self.users, self.staff, self.message, self.pigeon = create_fixtures()
+
+    @override_settings(PIGEONPOST_BULK_CHUNK=1)
+    def test_small_chunks(self):
+        """ Outbox rows are still all created when inserted in many small batches """
+        process_queue(force=True)
+        self.assertEqual(Outbox.objects.count(), 2)
+        self.assertEqual(Pigeon.objects.get(id=self.pigeon.id).successes, 2)
+
+    def test_duplicate_in_batch(self):
+        """ A row created by another process doesn't stop the rest of the batch """
+        andrew, bob = self.users[:2]
+        Outbox(pigeon=self.pigeon, user=andrew, message='').save()
+        _create_outboxes([Outbox(pigeon=self.pigeon, user=andrew, message=''),
+                Outbox(pigeon=self.pigeon, user=bob, message='')])
+        self.assertEqual(Outbox.objects.filter(pigeon=self.pigeon).count(), 2)
+
+
+class TestRecipientStreaming(TestCase):
+
+    def setUp(self):
+        self.users, self.staff, self.message, self.pigeon = create_fixtures()
+
+    def test_active_users_in_chunks(self):
+        """ All active users are visited once, in primary key order """
+        self.users[1].is_active = False
+        self.users[1].save()
+        expected = [u.pk for u in User.objects.filter(is_active=True).order_by('pk')]
+        self.assertEqual([u.pk for u in active_users(chunk_size=2)], expected)
+
+    def test_unique(self):
+        andrew, bob = self.users[:2]
+        self.assertEqual(list(unique([bob, andrew, bob, andrew])), [bob, andrew])
+
+    @override_settings(PIGEONPOST_BULK_CHUNK=1)
+    def test_broadcast_in_chunks(self):
+        send_email(force=True)
+        self.assertEqual(len(mail.outbox), 2)
+
+    def test_id_set(self):
+        ids = IdSet([3, 1000, 0])
+        self.assertTrue(3 in ids)
+        self.assertTrue(1000 in ids)
+        self.assertTrue(0 in ids)
+        self.assertFalse(4 in ids)
+        self.assertFalse(10**6 in ids)
+
+
+class TestRenderPool(TestCase):
+
+    def setUp(self):
+        self.users, self.staff, _, _ = create_fixtures(create_message=False)
+        ModeratedNews(subject='...', body='...', published=True).save()
+
+    def _check_outboxes(self):
+        messages = Outbox.objects.all()
+        self.assertEqual(len(messages), 2)
+        for m in messages:
+            assert m.user in self.staff
+
+    @override_settings(PIGEONPOST_RENDER_WORKERS=2, PIGEONPOST_RENDER_CHUNK=1)
+    def test_thread_pool(self):
+        process_queue()
+        self._check_outboxes()
+
+    @override_settings(PIGEONPOST_RENDER_WORKERS=2, PIGEONPOST_RENDER_POOL='process',
+            PIGEONPOST_RENDER_CHUNK=1)
+    def test_process_pool(self):
+        process_queue()
+        self._check_outboxes()
+
+    def test_unpicklable_source(self):
+        """ Sources that can't be sent to a render process are rendered in threads """
+        render_pool = RenderPool(1, 'process')
+        try:
+            self.assertTrue(isinstance(render_pool.pool_for(lambda: None), ThreadPool))
+        finally:
+            render_pool.close()
+
+    def test_thread_connections_closed(self):
+        """ The connections the render threads open are closed once, as the pool shuts down """
+        closed = []
+        class Source(object):
+            def render_email(self, user):
+                # SQLite never closes an in-memory database, so just note
+                # that the thread's connection is closed
+                thread_connection = connections['default']
+                thread_connection.close = lambda: closed.append(thread_connection)
+        render_pool = RenderPool(1, 'thread')
+        try:
+            tasks = [(Source(), 'render_email', [user]) for user in self.users[:2]]
+            self.assertEqual(len(list(render_pool.map(Source(), tasks))), 2)
+            self.assertEqual(closed, [])
+        finally:
+            render_pool.close()
+        self.assertEqual(len(closed), 1)
+        self.assertFalse(closed[0] is connections['default'])
+
+
+class TestBulkRender(TestCase):
+
+    def setUp(self):
+        self.users, self.staff, _, _ = create_fixtures(create_message=False)
+        AggregateNews(news_bit='Bob is a great guy.').save()
+        AggregateNews(news_bit='Bob is still a great guy.').save()
+        self._render_email = AggregateNews.__dict__['render_email']
+
+    def tearDown(self):
+        AggregateNews.render_email = self._render_email
+
+    def test_bulk_method_preferred(self):
+        """ render_email_bulk is used instead of calling render_email for each user """
+        def fail(cls, user):
+            raise AssertionError("render_email should not be called")
+        AggregateNews.render_email = classmethod(fail)
+        pigeonpost_queue.send(sender=AggregateNews)
+        process_queue()
+        messages = Outbox.objects.all()
+        self.assertEqual(len(messages), len(self.users))
+        send_email()
+        self.assertEqual(mail.outbox[0].body, 'Bob is a great guy.\nBob is still a great guy.')
+
+
+class TestSourceLoading(TestCase):
+
+    def setUp(self):
+        self.users, self.staff, self.message, self.pigeon = create_fixtures()
+        News(subject='Another', body='Another test message').save()
+        News(subject='Gone', body='A message that will be deleted').save()
+
+    def test_one_query_per_content_type(self):
+        pigeons = list(Pigeon.objects.all())
+        with self.assertNumQueries(1):
+            sources = _load_sources(pigeons)
+        self.assertEqual(len(sources), 3)
+        self.assertEqual(_get_source(self.pigeon, sources), self.message)
+
+    def test_missing_source(self):
+        """ Pigeons whose source has been deleted are marked as failed """
+        gone = News.objects.get(subject='Gone')
+        pigeon = Pigeon.objects.get(source_id=gone.id)
+        News.objects.filter(id=gone.id).delete()
+        process_queue(force=True)
+        pigeon = Pigeon.objects.get(id=pigeon.id)
+        self.assertEqual(pigeon.to_send, False)
+        self.assertEqual(pigeon.failures, 1)
+        self.assertEqual(Outbox.objects.filter(pigeon=pigeon).count(), 0)
+        self.assertEqual(Outbox.objects.count(), 4)
+
+
+class TestIndexes(TestCase):
+
+    def test_queue_indexes(self):
+        from django.db import connection
+        with connection.cursor() as cursor:
+            pigeon_indexes = connection.introspection.get_constraints(cursor, 'pigeonpost_pigeon')
+            outbox_indexes = connection.introspection.get_constraints(cursor, 'pigeonpost_outbox')
+        self.assertTrue('pigeonpost_pigeon_due' in pigeon_indexes)
+        self.assertTrue('pigeonpost_outbox_pending' in outbox_indexes)
+
+
+class TestUpsertEnqueue(TestCase):
+
+    def setUp(self):
+        self.users, self.staff, self.message, self.pigeon = create_fixtures()
+
+    def _check_enqueue(self):
+        ct = ContentType.objects.get_for_model(self.message)
+        pigeonpost_queue.send(sender=self.message, defer_for=10)
+        self.assertEqual(Pigeon.objects.filter(source_content_type=ct).count(), 1)
+        process_queue(force=True)
+        # A sent pigeon is left alone...
+        pigeonpost_queue.send(sender=self.message)
+        pigeon = Pigeon.objects.get(id=self.pigeon.id)
+        self.assertEqual(pigeon.to_send, False)
+        # ... unless it is retried
+        pigeonpost_queue.send(sender=self.message, retry=True)
+        pigeon = Pigeon.objects.get(id=self.pigeon.id)
+        self.assertEqual(pigeon.to_send, True)
+        self.assertEqual(Pigeon.objects.filter(source_content_type=ct).count(), 1)
+        # Model class pigeons are rescheduled while unsent, and created again once sent
+        bob = self.users[1]
+        pigeonpost_queue.send(sender=AggregateNews, send_to=bob)
+        pigeonpost_queue.send(sender=AggregateNews, send_to=bob)
+        self.assertEqual(Pigeon.objects.filter(source_id=None).count(), 1)
+        process_queue()
+        pigeonpost_queue.send(sender=AggregateNews, send_to=bob)
+        self.assertEqual(Pigeon.objects.filter(source_id=None).count(), 2)
+
+    def test_upsert(self):
+        self._check_enqueue()
+
+    def test_get_or_create(self):
+        supports_upsert = tasks._supports_upsert
+        tasks._supports_upsert = lambda connection: False
+        try:
+            self._check_enqueue()
+        finally:
+            tasks._supports_upsert = supports_upsert
+
+    def test_unique_pigeons(self):
+        """ The database refuses a second pigeon for the same source """
+        from django.db import connection, transaction, IntegrityError
+        if connection.vendor not in ('postgresql', 'sqlite'):
+            return
+        with self.assertRaises(IntegrityError):
+            with transaction.atomic():
+                Pigeon(source_content_type=self.pigeon.source_content_type,
+                        source_id=self.message.id, scheduled_for=self.pigeon.scheduled_for).save()
+
+
+class TestQueueMany(TestCase):
+
+    def setUp(self):
+        self.users, self.staff, _, _ = create_fixtures(create_message=False)
+        self.news = [BobsNews(subject='News %d' % i, body='...') for i in range(5)]
+        for news in self.news:
+            news.save()
+        self.ct = ContentType.objects.get_for_model(BobsNews)
+
+    def _check_queue_many(self):
+        bob = self.users[1]
+        queue_many(self.news + self.news[:2], render_email_method='email_news', send_to=bob,
+                defer_for=100)
+        pigeons = Pigeon.objects.filter(source_content_type=self.ct)
+        self.assertEqual(pigeons.count(), 5)
+        self.assertEqual(pigeons.filter(to_send=True).count(), 5)
+        # Send two of them, then queue them all again
+        Pigeon.objects.filter(source_id__in=[n.id for n in self.news[:2]]).update(to_send=False)
+        scheduled_for = datetime.datetime.now().replace(microsecond=0)
+        queue_many(self.news, render_email_method='email_news', send_to=bob,
+                scheduled_for=scheduled_for)
+        self.assertEqual(pigeons.count(), 5)
+        self.assertEqual(pigeons.filter(to_send=True, scheduled_for=scheduled_for).count(), 3)
+        queue_many(self.news, render_email_method='email_news', send_to=bob,
+                scheduled_for=scheduled_for, retry=True)
+        self.assertEqual(pigeons.filter(to_send=True, scheduled_for=scheduled_for).count(), 5)
+        # Model class pigeons
+        queue_many([AggregateNews, AggregateNews], send_to=bob)
+        self.assertEqual(Pigeon.objects.filter(source_id=None).count(), 1)
+
+    def test_queue_many(self):
+        with self.assertNumQueries(1):
+            queue_many(self.news, render_email_method='email_news')
+        Pigeon.objects.all().delete()
+        self._check_queue_many()
+
+    def test_queue_many_without_upsert(self):
+        supports_upsert = tasks._supports_upsert
+        tasks._supports_upsert = lambda connection: False
+        try:
+            self._check_queue_many()
+        finally:
+            tasks._supports_upsert = supports_upsert
+
+
+@override_settings(PIGEONPOST_COALESCE_ON_COMMIT=True)
+class TestCoalesceOnCommit(TransactionTestCase):
+
+    def setUp(self):
+        self.ct = ContentType.objects.get_for_model(News)
+
+    def test_coalesced(self):
+        with transaction.atomic():
+            news = News(subject='Test', body='A test message')
+            news.save()
+            news.save()
+            scheduled_for = datetime.datetime.now().replace(microsecond=0)
+            pigeonpost_queue.send(sender=news, scheduled_for=scheduled_for)
+            self.assertEqual(Pigeon.objects.count(), 0)
+        pigeon = Pigeon.objects.get(source_content_type=self.ct, source_id=news.id)
+        self.assertEqual(pigeon.scheduled_for, scheduled_for)
+
+    def test_rolled_back(self):
+        try:
+            with transaction.atomic():
+                News(subject='Test', body='A test message').save()
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(Pigeon.objects.count(), 0)
+        # The next transaction isn't affected
+        with transaction.atomic():
+            News(subject='Test', body='A test message').save()
+        self.assertEqual(Pigeon.objects.count(), 1)
+
+    def test_savepoint_rolled_back(self):
+        with transaction.atomic():
+            News(subject='Kept', body='...').save()
+            try:
+                with transaction.atomic():
+                    News(subject='Rolled back', body='...').save()
+                    raise ValueError
+            except ValueError:
+                pass
+        self.assertEqual(Pigeon.objects.count(), 1)
+        self.assertEqual(News.objects.get(id=Pigeon.objects.get().source_id).subject, 'Kept')
+
+    def test_nested_atomic(self):
+        """ Pigeons queued in and around a savepoint are queued once, and the last schedule wins """
+        first = datetime.datetime.now().replace(microsecond=0)
+        second = first + datetime.timedelta(hours=1)
+        third = first + datetime.timedelta(hours=2)
+        enqueued = []
+        enqueue = tasks._enqueue
+        tasks._enqueue = lambda pigeons: enqueued.append(dict(pigeons)) or enqueue(pigeons)
+        try:
+            with transaction.atomic():
+                news = News(subject='Test', body='A test message')
+                news.save()
+                pigeonpost_queue.send(sender=news, scheduled_for=first)
+                with transaction.atomic():
+                    pigeonpost_queue.send(sender=news, scheduled_for=second)
+                pigeonpost_queue.send(sender=news, scheduled_for=third)
+        finally:
+            tasks._enqueue = enqueue
+        self.assertEqual(len(enqueued), 1)
+        self.assertEqual(Pigeon.objects.get(source_content_type=self.ct, source_id=news.id).scheduled_for, third)
+
+    def test_nested_savepoint_rolled_back(self):
+        """ Rolling back a savepoint only forgets what was queued within it """
+        first = datetime.datetime.now().replace(microsecond=0)
+        second = first + datetime.timedelta(hours=1)
+        with transaction.atomic():
+            news = News(subject='Kept', body='...')
+            news.save()
+            pigeonpost_queue.send(sender=news, scheduled_for=first)
+            try:
+                with transaction.atomic():
+                    pigeonpost_queue.send(sender=news, scheduled_for=second)
+                    News(subject='Rolled back', body='...').save()
+                    raise ValueError
+            except ValueError:
+                pass
+        pigeon = Pigeon.objects.get()
+        self.assertEqual(pigeon.source_id, news.id)
+        self.assertEqual(pigeon.scheduled_for, first)
+
+    def test_autocommit(self):
+        """ Outside of a transaction pigeons are queued straight away """
+        News(subject='Test', body='A test message').save()
+        self.assertEqual(Pigeon.objects.count(), 1)
+
+
+class TestConcurrentSending(TestCase):
+
+    def setUp(self):
+        self.users, self.staff, self.message, self.pigeon = create_fixtures()
+        for i in range(10):
+            user = User(username='u%d' % i, email='u%d@example.com' % i)
+            user.save()
+            Profile(user=user, subscribed_to_news=True).save()
+
+    @override_settings(PIGEONPOST_SMTP_CONCURRENCY=3)
+    def test_concurrent_sending(self):
+        send_email(force=True)
+        self.assertEqual(len(mail.outbox), 12)
+        self.assertEqual(Outbox.objects.filter(succeeded=True, sent_at__isnull=False).count(), 12)
+        # Nothing is sent twice
+        send_email(force=True)
+        self.assertEqual(len(mail.outbox), 12)
+
+    @override_settings(PIGEONPOST_SMTP_CONCURRENCY=3)
+    def test_concurrent_failures(self):
+        get_connection = mail.get_connection
+        mail.get_connection = lambda *aa, **kw: FailingSMTPConnection()
+        try:
+            send_email(force=True)
+        finally:
+            mail.get_connection = get_connection
+        self.assertEqual(Outbox.objects.filter(succeeded=False, failures=1).count(), 12)
+
+
+class FlakySMTPConnection(object):
+    """ A connection that is dropped by the server after every two messages """
+    opened = 0
+
+    def __init__(self, *aa, **kw):
+        self.sent = 0
+
+    def open(self):
+        FlakySMTPConnection.opened += 1
+
+    def send_messages(self, messages):
+        if self.sent == 2:
+            raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+        self.sent += 1
+        mail.outbox.extend(messages)
+        return len(messages)
+
+    def close(self):
+        pass
+
+class UnreachableSMTPConnection(object):
+    def open(self):
+        raise smtplib.socket.error("Connection refused")
+
+    def close(self):
+        pass
+
+class TestManagedConnection(TestCase):
+
+    def setUp(self):
+        self.users, self.staff, self.message, self.pigeon = create_fixtures()
+        for i in range(3):
+            user = User(username='u%d' % i, email='u%d@example.com' % i)
+            user.save()
+            Profile(user=user, subscribed_to_news=True).save()
+        process_queue(force=True)
+        self._get_conn = mail.get_connection
+        FlakySMTPConnection.opened = 0
+
+    def tearDown(self):
+        mail.get_connection = self._get_conn
+
+    def test_reconnect(self):
+        """ A dropped connection is reopened, and the message is still sent """
+        mail.get_connection = FlakySMTPConnection
+        send_email()
+        self.assertEqual(Outbox.objects.filter(succeeded=True).count(), 5)
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertEqual(FlakySMTPConnection.opened, 3)
+
+    @override_settings(PIGEONPOST_MAX_MESSAGES_PER_CONNECTION=1)
+    def test_max_messages_per_connection(self):
+        mail.get_connection = FlakySMTPConnection
+        send_email()
+        self.assertEqual(Outbox.objects.filter(succeeded=True).count(), 5)
+        self.assertEqual(FlakySMTPConnection.opened, 5)
+
+    @override_settings(PIGEONPOST_SMTP_CONNECT_ATTEMPTS=1)
+    def test_unreachable_server(self):
+        """ If the server can't be reached, messages aren't marked as failed """
+        mail.get_connection = UnreachableSMTPConnection
+        send_email()
+        self.assertEqual(Outbox.objects.filter(succeeded=False, failures=0).count(), 5)
+
+    @override_settings(PIGEONPOST_SMTP_CONNECT_ATTEMPTS=1, PIGEONPOST_SMTP_CONCURRENCY=2)
+    def test_unreachable_server_concurrent(self):
+        mail.get_connection = UnreachableSMTPConnection
+        send_email()
+        self.assertEqual(Outbox.objects.filter(succeeded=False, failures=0).count(), 5)
+
+
+class PipeliningChannel(smtpd.SMTPChannel):
+    """ smtpd only speaks HELO, so add EHLO advertising PIPELINING """
+
+    def smtp_EHLO(self, arg):
+        self._SMTPChannel__greeting = arg
+        self.push('250-localhost\r\n250 PIPELINING')
+
+    def smtp_RCPT(self, arg):
+        address = self._SMTPChannel__getaddr('TO:', arg) if arg else None
+        if address in self._SMTPChannel__server.refuse_rcpt:
+            self.push('550 No such user')
+            return
+        smtpd.SMTPChannel.smtp_RCPT(self, arg)
+
+
+class StandInSMTPServer(smtpd.SMTPServer):
+    """ A local SMTP server that keeps the messages it receives """
+
+    def __init__(self, refuse=(), refuse_rcpt=()):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.refuse = refuse
+        self.refuse_rcpt = refuse_rcpt
+        self.received = []
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            conn, addr = pair
+            PipeliningChannel(self, conn, addr)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        if any(rcpt in self.refuse for rcpt in rcpttos):
+            return '554 Refused'
+        self.received.append((mailfrom, rcpttos, data))
+
+    def start(self):
+        self.thread = threading.Thread(target=asyncore.loop, kwargs={'timeout': 0.05})
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        asyncore.close_all()
+        self.thread.join()
+
+
+class TestAsyncEngine(TestCase):
+
+    def setUp(self):
+        self.users, self.staff, self.message, self.pigeon = create_fixtures()
+        for i in range(3):
+            user = User(username='u%d' % i, email='u%d@example.com' % i)
+            user.save()
+            Profile(user=user, subscribed_to_news=True).save()
+        process_queue(force=True)
+
+    def _send(self, server, **settings):
+        server.start()
+        try:
+            with override_settings(EMAIL_HOST='127.0.0.1', EMAIL_PORT=server.port,
+                    EMAIL_HOST_USER='', PIGEONPOST_OUTBOX_ENGINE='async', **settings):
+                send_email()
+        finally:
+            server.stop()
+
+    def test_send(self):
+        server = StandInSMTPServer()
+        self._send(server, PIGEONPOST_ASYNC_CONNECTIONS=2)
+        self.assertEqual(Outbox.objects.filter(succeeded=True).count(), 5)
+        self.assertEqual(len(server.received), 5)
+        recipients = sorted(rcpt for mailfrom, rcpttos, data in server.received for rcpt in rcpttos)
+        self.assertEqual(recipients, sorted(o.user.email for o in Outbox.objects.all()))
+        self.assertTrue(all('Subject: ' in data for mailfrom, rcpttos, data in server.received))
+
+    def test_refused(self):
+        """ A refused message is counted as a failure, and the rest are still sent """
+        server = StandInSMTPServer(refuse=['u0@example.com'])
+        self._send(server)
+        self.assertEqual(Outbox.objects.filter(succeeded=True).count(), 4)
+        failed = Outbox.objects.get(succeeded=False)
+        self.assertEqual(failed.user.username, 'u0')
+        self.assertEqual(failed.failures, 1)
+
+    def test_unreachable_server(self):
+        """ If the server can't be reached, messages aren't marked as failed """
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        with override_settings(EMAIL_HOST='127.0.0.1', EMAIL_PORT=port,
+                PIGEONPOST_OUTBOX_ENGINE='async', PIGEONPOST_SMTP_CONNECT_ATTEMPTS=1):
+            send_email()
+        self.assertEqual(Outbox.objects.filter(succeeded=False, failures=0).count(), 5)
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+    def scheduler(self):
+        """ A DomainScheduler class that runs on this clock, to stand in for the real one """
+        clock = self
+        class FakeClockScheduler(DomainScheduler):
+            def __init__(self, *args, **kwargs):
+                kwargs.update(clock=clock, sleep=clock.sleep)
+                DomainScheduler.__init__(self, *args, **kwargs)
+        return FakeClockScheduler
+
+
+class TestDomainScheduling(TestCase):
+
+    def test_token_bucket(self):
+        clock = FakeClock()
+        bucket = TokenBucket(2, 3, clock=clock)
+        self.assertEqual([bucket.take() for i in range(4)], [True, True, True, False])
+        self.assertEqual(bucket.wait(), 0.5)
+        clock.sleep(0.5)
+        self.assertTrue(bucket.take())
+        self.assertFalse(bucket.take())
+
+    def test_round_robin(self):
+        """ Domains take turns, rather than one domain going first """
+        items = ['a.com'] * 4 + ['b.com'] * 2 + ['c.com']
+        scheduler = DomainScheduler()
+        order = list(scheduler.schedule(enumerate(items), lambda item: item[1]))
+        self.assertEqual([domain for i, domain in order],
+                ['a.com', 'b.com', 'c.com', 'a.com', 'b.com', 'a.com', 'a.com'])
+
+    def test_throttled_domains_deferred(self):
+        clock = FakeClock()
+        items = ['a.com'] * 5 + ['b.com'] * 2
+        scheduler = DomainScheduler(rates={'a.com': (1, 2)}, max_wait=0, clock=clock, sleep=clock.sleep)
+        order = list(scheduler.schedule(items, lambda item: item))
+        self.assertEqual(order, ['a.com', 'b.com', 'a.com', 'b.com'])
+        self.assertEqual(scheduler.deferred, {'a.com': 3})
+
+    def test_rate_limited_by_default(self):
+        """ Past its burst, a domain is sent to at its rate rather than deferred """
+        clock = FakeClock()
+        items = ['a.com'] * 5 + ['b.com'] * 2
+        scheduler = DomainScheduler(rates={'a.com': (1, 2)}, clock=clock, sleep=clock.sleep)
+        order = list(scheduler.schedule(items, lambda item: item))
+        self.assertEqual(sorted(order), sorted(items))
+        self.assertEqual(scheduler.deferred, {})
+        self.assertEqual(clock.now, 3.0)
+
+    def test_wait_for_tokens(self):
+        clock = FakeClock()
+        scheduler = DomainScheduler(rate=2, burst=1, max_wait=1, clock=clock, sleep=clock.sleep)
+        order = list(scheduler.schedule(['a.com'] * 3, lambda item: item))
+        self.assertEqual(len(order), 3)
+        self.assertEqual(clock.now, 1.0)
+
+    def test_stopped_while_waiting(self):
+        stop = threading.Event()
+        stop.set()
+        scheduler = DomainScheduler(rate=1, burst=1, stop=stop)
+        self.assertEqual(list(scheduler.schedule(['a.com'] * 3, lambda item: item)), ['a.com'])
+
+    @override_settings(PIGEONPOST_DOMAIN_RATES={'example.com': (1, 1)}, PIGEONPOST_DOMAIN_MAX_WAIT=60)
+    def test_sent_at_domain_rate(self):
+        """ Throttled messages are sent as their domain's tokens come in, not all at the end """
+        create_fixtures()
+        for i in range(4):
+            user = User(username='u%d' % i, email='u%d@example.com' % i)
+            user.save()
+            Profile(user=user, subscribed_to_news=True).save()
+        process_queue(force=True)
+        clock = FakeClock()
+        sent_at = []
+        def pre_send(sender, **kwargs):
+            sent_at.append(clock.now)
+        pigeonpost_pre_send.connect(pre_send)
+        tasks.DomainScheduler = clock.scheduler()
+        try:
+            send_email()
+        finally:
+            tasks.DomainScheduler = DomainScheduler
+            pigeonpost_pre_send.disconnect(pre_send)
+        self.assertEqual(sent_at, [0, 1, 2, 3, 4, 5])
+        self.assertEqual(Outbox.objects.filter(succeeded=True).count(), 6)
+
+    @override_settings(PIGEONPOST_DOMAIN_RATES={'example.com': (1, 2)}, PIGEONPOST_DOMAIN_MAX_WAIT=0)
+    def test_throttled_messages_not_failed(self):
+        create_fixtures()
+        User.objects.filter(username='b').update(email='b@example.org')
+        for i in range(3):
+            user = User(username='u%d' % i, email='u%d@example.com' % i)
+            user.save()
+            Profile(user=user, subscribed_to_news=True).save()
+        process_queue(force=True)
+        send_email()
+        self.assertEqual(Outbox.objects.filter(succeeded=True).count(), 3)
+        self.assertEqual(Outbox.objects.filter(succeeded=False, failures=0).count(), 2)
+        self.assertEqual(sorted(m.to[0].split('@')[1] for m in mail.outbox),
+                ['example.com', 'example.com', 'example.org'])
+
+
+class TestClaiming(TestCase):
+
+    def setUp(self):
+        self.users, self.staff, self.message, self.pigeon = create_fixtures()
+
+    def test_claim(self):
+        process_queue(force=True)
+        pending = Outbox.objects.filter(succeeded=False).order_by('id')
+        ours, theirs = Claimer(), Claimer()
+        ids = ours.claim(pending, 1)
+        self.assertEqual(len(ids), 1)
+        self.assertEqual(Outbox.objects.get(id=ids[0]).claimed_by, ours.worker)
+        # Rows claimed by another worker are skipped
+        self.assertEqual(len(theirs.claim(pending, 10)), 1)
+        self.assertEqual(theirs.claim(pending, 10), [])
+        ours.release(Outbox)
+        self.assertEqual(theirs.claim(pending, 10), ids)
+
+    def test_expired_lease(self):
+        """ Rows claimed by a worker that has gone away are claimed again once the lease expires """
+        pending = Pigeon.objects.filter(to_send=True)
+        crashed = Claimer(lease=-1)
+        ids = crashed.claim(pending, 10)
+        self.assertEqual(Claimer().claim(pending, 10), ids)
+
+    def test_lease_renewed(self):
+        """ A worker that is slow to send its messages keeps them from other workers """
+        process_queue(force=True)
+        pending = Outbox.objects.filter(succeeded=False).order_by('id')
+        ours = Claimer(lease=60)
+        self.assertEqual(len(ours.claim(pending, 10)), 2)
+        messages = tasks._renewing_claims(iter(list(pending)), ours)
+        next(messages)
+        # Much later, the leases are about to run out, and it is time to renew them
+        Outbox.objects.update(claimed_until=now() + datetime.timedelta(seconds=1))
+        ours.renew_at = 0
+        next(messages)
+        for outbox in Outbox.objects.all():
+            self.assertTrue(outbox.claimed_until > now() + datetime.timedelta(seconds=50))
+        self.assertEqual(Claimer().claim(pending, 10), [])
+
+    def test_lease_expired(self):
+        """ Without renewing, another worker takes over once the lease has run out """
+        process_queue(force=True)
+        pending = Outbox.objects.filter(succeeded=False).order_by('id')
+        ours = Claimer(lease=60)
+        ids = ours.claim(pending, 10)
+        messages = tasks._renewing_claims(iter(list(pending)), ours)
+        next(messages)
+        Outbox.objects.update(claimed_until=now() - datetime.timedelta(seconds=1))
+        next(messages)
+        self.assertEqual(Claimer().claim(pending, 10), ids)
+
+    @override_settings(PIGEONPOST_CLAIM_WORK=True, PIGEONPOST_DOMAIN_RATES={'example.com': (1, 1)},
+            PIGEONPOST_DOMAIN_MAX_WAIT=60)
+    def test_lease_renewed_while_throttled(self):
+        """ Leases are renewed as each message gets through the domain rate limit """
+        process_queue(force=True)
+        clock = FakeClock()
+        renewed_at = []
+        heartbeat = Claimer.__dict__['heartbeat']
+        def record_heartbeat(claimer, model):
+            renewed_at.append(clock.now)
+            return heartbeat(claimer, model)
+        Claimer.heartbeat = record_heartbeat
+        tasks.DomainScheduler = clock.scheduler()
+        try:
+            send_email()
+        finally:
+            Claimer.heartbeat = heartbeat
+            tasks.DomainScheduler = DomainScheduler
+        self.assertEqual(renewed_at, [0, 1])
+        self.assertEqual(len(mail.outbox), 2)
+
+    @override_settings(PIGEONPOST_CLAIM_WORK=True)
+    def test_deploy(self):
+        other = Claimer()
+        other.claim(Pigeon.objects.filter(id=self.pigeon.id), 1)
+        process_queue(force=True)
+        # The pigeon that another worker is busy with is left alone
+        self.assertEqual(Pigeon.objects.get(id=self.pigeon.id).to_send, True)
+        self.assertEqual(Pigeon.objects.filter(to_send=True).count(), 1)
+        other.release(Pigeon)
+        process_queue(force=True)
+        other.claim(Outbox.objects.order_by('id'), 1)
+        send_email()
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(Outbox.objects.filter(succeeded=False).count(), 1)
+        self.assertEqual(Outbox.objects.filter(claimed_by__isnull=False).count(), 1)
+        self.assertEqual(Pigeon.objects.filter(claimed_by__isnull=False).count(), 0)
+
+
+class TestSeparatePhases(TestCase):
+
+    def setUp(self):
+        self.users, self.staff, self.message, self.pigeon = create_fixtures()
+        Pigeon.objects.update(scheduled_for=now())
+
+    def test_queue_and_outbox_only(self):
+        call_command('deploy_pigeons', queue_only=True)
+        self.assertEqual(Outbox.objects.count(), 2)
+        self.assertEqual(len(mail.outbox), 0)
+        call_command('deploy_pigeons', outbox_only=True)
+        self.assertEqual(len(mail.outbox), 2)
+
+    def test_outbox_sent_while_queue_locked(self):
+        """ Another process rendering the queue doesn't hold up sending """
+        process_queue()
+        Pigeon.objects.update(to_send=True)
+        with open('pigeonpost-queue.pid', 'w') as pidfile:
+            pidfile.write(str(os.getpid()))
+        try:
+            send_email()
+        finally:
+            os.remove('pigeonpost-queue.pid')
+        self.assertEqual(Pigeon.objects.filter(to_send=True).count(), Pigeon.objects.count())
+        self.assertEqual(len(mail.outbox), 2)
+
+
+class TestBatchedResults(TestCase):
+
+    def setUp(self):
+        self.users, self.staff, self.message, self.pigeon = create_fixtures()
+        for i in range(3):
+            user = User(username='u%d' % i, email='u%d@example.com' % i)
+            user.save()
+            Profile(user=user, subscribed_to_news=True).save()
+        process_queue(force=True)
+
+    def _updates(self, queries):
+        return [q['sql'] for q in queries if q['sql'].startswith('UPDATE')]
+
+    def test_one_update_per_batch(self):
+        sent = []
+        def post_send(sender, successful, **kwargs):
+            sent.append(successful)
+        pigeonpost_post_send.connect(post_send)
+        try:
+            with CaptureQueriesContext(connection) as queries:
+                send_email()
+        finally:
+            pigeonpost_post_send.disconnect(post_send)
+        updates = self._updates(queries)
+        self.assertEqual(len(updates), 1)
+        # The payload isn't written back
+        self.assertFalse('"message"' in updates[0])
+        self.assertEqual(sent, [True] * 5)
+        sent_at = set(Outbox.objects.values_list('sent_at', flat=True))
+        self.assertFalse(None in sent_at)
+        self.assertEqual(Outbox.objects.filter(succeeded=True).count(), 5)
+
+    @override_settings(PIGEONPOST_RESULT_BATCH=2)
+    def test_batch_size(self):
+        with CaptureQueriesContext(connection) as queries:
+            send_email()
+        self.assertEqual(len(self._updates(queries)), 3)
+        self.assertEqual(Outbox.objects.filter(succeeded=True).count(), 5)
+
+    def test_failures(self):
+        get_connection = mail.get_connection
+        mail.get_connection = lambda *aa, **kw: FailingSMTPConnection()
+        try:
+            send_email()
+        finally:
+            mail.get_connection = get_connection
+        self.assertEqual(Outbox.objects.filter(failures=1, succeeded=False).count(), 5)
+        self.assertFalse(Outbox.objects.filter(next_attempt_at__lte=now()).exists())
+
+
+class TestOutboxPagination(TestCase):
+
+    def setUp(self):
+        self.users, self.staff, self.message, self.pigeon = create_fixtures()
+        for i in range(3):
+            user = User(username='u%d' % i, email='u%d@example.com' % i)
+            user.save()
+            Profile(user=user, subscribed_to_news=True).save()
+        process_queue(force=True)
+
+    @override_settings(PIGEONPOST_BULK_CHUNK=2)
+    def test_pages(self):
+        with CaptureQueriesContext(connection) as queries:
+            send_email()
+        self.assertEqual(Outbox.objects.filter(succeeded=True).count(), 5)
+        self.assertEqual(len(mail.outbox), 5)
+        selects = [q['sql'] for q in queries
+                if q['sql'].startswith('SELECT') and 'FROM "pigeonpost_outbox"' in q['sql']]
+        pages = [sql for sql in selects if '"pigeonpost_outbox"."message"' not in sql]
+        payloads = [sql for sql in selects if '"pigeonpost_outbox"."message"' in sql]
+        # Three pages of two, and an empty one to finish, each without the payloads,
+        # which are loaded a page at a time
+        self.assertEqual(len(pages), 4)
+        self.assertEqual(len(payloads), 3)
+
+
+class CustomMessage(EmailMessage):
+    pass
+
+
+class TestSerializers(TestCase):
+
+    def _email(self):
+        email = EmailMultiAlternatives(u'Caf\xe9 news', u'The body ' * 50, 'news@example.com',
+                ['a@example.com'], cc=['b@example.com'], headers={'X-Pigeon': '1'})
+        email.attach_alternative(u'<p>The body</p>', 'text/html')
+        email.attach('data.bin', b'\x00\xff' * 10, 'application/octet-stream')
+        return email
+
+    def _check(self, email, loaded):
+        self.assertEqual(type(loaded), type(email))
+        for field in ('subject', 'body', 'from_email', 'to', 'cc', 'extra_headers',
+                'alternatives', 'attachments'):
+            self.assertEqual(getattr(loaded, field), getattr(email, field))
+
+    def test_round_trip(self):
+        email = self._email()
+        for codec in ('json', 'pickle'):
+            for compress in (True, False):
+                payload = serializers.dumps(email, codec, compress)
+                self.assertEqual(payload[:4], 'PP\x01' + codec[0])
+                self._check(email, serializers.loads(payload))
+
+    def test_compression(self):
+        email = self._email()
+        self.assertTrue(len(serializers.dumps(email, compress=True)) <
+                len(serializers.dumps(email, compress=False)))
+
+    def test_pickle_fallback(self):
+        """ Messages the json codec can't represent are pickled """
+        payload = serializers.dumps(CustomMessage('Hi', 'Body', to=['a@example.com']), 'json')
+        self.assertEqual(payload[3], 'p')
+
+    def test_legacy_payloads(self):
+        email = self._email()
+        self._check(email, serializers.loads(pickle.dumps(email, 2).encode('base64')))
+        self._check(email, serializers.loads(pickle.dumps(email)))
+
+    def test_add_to_outbox(self):
+        """ Messages added with add_to_outbox can be sent """
+        user = User.objects.create(username='a', email='a@example.com')
+        tasks.add_to_outbox(EmailMessage('Hi', 'Body', to=[user.email]), user)
+        send_email()
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].subject, 'Hi')
+
+
+class TestRawMessages(TestCase):
+
+    def setUp(self):
+        self.users, self.staff, self.message, self.pigeon = create_fixtures()
+
+    @override_settings(PIGEONPOST_SERIALIZER='mime')
+    def test_send(self):
+        process_queue(force=True)
+        send_email()
+        self.assertEqual(len(mail.outbox), 2)
+        for email in mail.outbox:
+            self.assertTrue(isinstance(email, serializers.RawEmailMessage))
+            self.assertTrue('Subject: %s' % email.subject in email.message().as_bytes())
+
+    @override_settings(PIGEONPOST_SERIALIZER='mime', PIGEONPOST_SINK_EMAIL='sink@example.com')
+    def test_sink_rewrites_envelope(self):
+        """ Rerouting to the sink changes the recipients, but not the headers """
+        process_queue(force=True)
+        server = StandInSMTPServer()
+        server.start()
+        try:
+            with override_settings(EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+                    EMAIL_HOST='127.0.0.1', EMAIL_PORT=server.port):
+                send_email()
+        finally:
+            server.stop()
+        self.assertEqual(len(server.received), 2)
+        recipients = set(user.email for user in self.users if user.get_profile().subscribed_to_news)
+        for mailfrom, rcpttos, data in server.received:
+            self.assertEqual(rcpttos, ['sink@example.com'])
+            self.assertTrue(any('To: %s' % email in data for email in recipients))
+
+    def test_envelope(self):
+        email = EmailMessage('Hi', 'Body', 'from@example.com', ['a@example.com'], bcc=['b@example.com'])
+        loaded = serializers.loads(serializers.dumps(email, 'mime'))
+        self.assertEqual(loaded.recipients(), ['a@example.com', 'b@example.com'])
+        self.assertEqual(loaded.from_email, 'from@example.com')
+        self.assertFalse('b@example.com' in loaded.message().as_bytes())
+
+
+@override_settings(PIGEONPOST_BLOB_MIN_SIZE=100)
+class TestBlobs(TestCase):
+
+    def setUp(self):
+        self.users, self.staff, self.message, self.pigeon = create_fixtures()
+        self.body = u'A long message for everyone \xe9 ' * 20
+        News.objects.filter(id=self.message.id).update(body=self.body)
+
+    def test_shared_body(self):
+        """ The body is stored once, and each message refers to it """
+        process_queue(force=True)
+        self.assertEqual(Blob.objects.count(), 1)
+        blob = Blob.objects.get()
+        self.assertEqual(bytes(blob.data), self.body.encode('utf-8'))
+        for outbox in Outbox.objects.all():
+            self.assertEqual(list(outbox.blobs.all()), [blob])
+            # The payload only has the hash, so a stand in blob replaces the body
+            self.assertEqual(serializers.loads(outbox.message, {blob.hash: 'x'}).body, 'x')
+        send_email()
+        self.assertEqual(len(mail.outbox), 2)
+        for email in mail.outbox:
+            self.assertEqual(email.body, self.body)
+
+    def test_garbage_collection(self):
+        process_queue(force=True)
+        self.assertEqual(blobs.collect_garbage(), 0)
+        Outbox.objects.all().delete()
+        # Recently stored blobs are kept, in case they are about to be linked
+        self.assertEqual(blobs.collect_garbage(), 0)
+        Blob.objects.update(stored_at=now() - datetime.timedelta(days=2))
+        self.assertEqual(blobs.collect_garbage(), 1)
+        self.assertEqual(Blob.objects.count(), 0)
+
+    def test_binary_attachments(self):
+        email = EmailMessage('Hi', 'Short', to=['a@example.com'])
+        email.attach('data.bin', b'\x00\xff' * 100, 'application/octet-stream')
+        parts = {}
+        payload = serializers.dumps(email, blobs=parts)
+        self.assertEqual(parts.values(), [b'\x00\xff' * 100])
+        self.assertEqual(serializers.loads(payload, parts).attachments, email.attachments)
+        self.assertRaises(serializers.SerializationError, serializers.loads, payload, {})
+
+
+class TestUserAgnostic(TestCase):
+
+    def setUp(self):
+        self.users, self.staff, self.message, self.pigeon = create_fixtures(create_message=False)
+        self.renders = []
+        self._render_email = Announcement.__dict__['render_email']
+        def render_email(announcement, user):
+            self.renders.append(user)
+            return self._render_email(announcement, user)
+        Announcement.render_email = user_agnostic(render_email)
+        self.announcement = Announcement.objects.create(subject='Hello', body='Hello everyone')
+        pigeonpost_queue.send(sender=self.announcement)
+
+    def tearDown(self):
+        Announcement.render_email = self._render_email
+
+    def test_rendered_once(self):
+        process_queue()
+        self.assertEqual(len(self.renders), 1)
+        self.assertEqual(Outbox.objects.count(), len(self.users))
+        send_email()
+        self.assertEqual(sorted(email.to[0] for email in mail.outbox),
+                sorted(user.email for user in self.users))
+        self.assertEqual(set(email.body for email in mail.outbox), set(['Hello everyone']))
+
+    @override_settings(PIGEONPOST_FANOUT_RCPT_BATCH=2)
+    def test_fanout(self):
+        """ Copies of the message are sent as one message to several recipients """
+        process_queue()
+        send_email()
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual(sorted(sum((email.recipients() for email in mail.outbox), [])),
+                sorted(user.email for user in self.users))
+        self.assertEqual(mail.outbox[0].message()['To'], 'undisclosed-recipients:;')
+        self.assertEqual(Outbox.objects.filter(succeeded=True).count(), len(self.users))
+
+    @override_settings(PIGEONPOST_FANOUT_RCPT_BATCH=10)
+    def test_fanout_failure(self):
+        """ If the group fails, each of its messages counts a failure """
+        process_queue()
+        get_connection = mail.get_connection
+        mail.get_connection = lambda *aa, **kw: FailingSMTPConnection()
+        try:
+            send_email()
+        finally:
+            mail.get_connection = get_connection
+        self.assertEqual(Outbox.objects.filter(failures=1).count(), len(self.users))
+
+    @override_settings(PIGEONPOST_FANOUT_RCPT_BATCH=10)
+    def _send_refusing(self, engine):
+        """ Send the copies as one message, to a server that refuses one of the recipients """
+        process_queue()
+        server = StandInSMTPServer(refuse_rcpt=['b@example.com'])
+        server.start()
+        try:
+            with override_settings(EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+                    EMAIL_HOST='127.0.0.1', EMAIL_PORT=server.port, EMAIL_HOST_USER=''):
+                send_email(engine=engine)
+        finally:
+            server.stop()
+        self.assertEqual(len(server.received), 1)
+        self.assertEqual(Outbox.objects.get(succeeded=False, failures=1).user.username, 'b')
+        self.assertEqual(Outbox.objects.filter(succeeded=True).count(), len(self.users) - 1)
+
+    def test_fanout_refused_recipient(self):
+        """ Only the messages for recipients the server refuses fail """
+        self._send_refusing(None)
+
+    def test_fanout_refused_recipient_async(self):
+        self._send_refusing('async')
+
+    def test_copies(self):
+        """ Users that get nothing are skipped, and copies don't keep the cc or bcc """
+        def render_email(user):
+            if user == self.users[0]:
+                return None
+            return EmailMessage('Hi', 'Body', to=[user.email], cc=['cc@example.com'],
+                    bcc=['bcc@example.com'])
+        rendered = list(render_copies(render_email, self.users))
+        self.assertEqual([user for user, email, encoded, parts in rendered], self.users)
+        self.assertEqual(rendered[0][2], None)
+        for user, email, encoded, parts in rendered[1:]:
+            self.assertEqual(email.recipients(), [user.email])
+
+
+class TestPruning(TestCase):
+
+    def setUp(self):
+        self.users, self.staff, self.message, self.pigeon = create_fixtures()
+        process_queue(force=True)
+        send_email()
+        self.old, self.recent = Outbox.objects.order_by('id')
+        Outbox.objects.filter(id=self.old.id).update(sent_at=now() - datetime.timedelta(days=40))
+
+    def test_prune(self):
+        self.assertEqual(prune_pigeons(batch_size=1), (1, 0))
+        self.assertEqual(list(Outbox.objects.all()), [self.recent])
+        summary = OutboxSummary.objects.get(pigeon=self.pigeon)
+        self.assertEqual(summary.pruned, 1)
+        self.assertTrue(summary.last_sent_at < now() - datetime.timedelta(days=39))
+        self.assertEqual(prune_pigeons(days=0), (1, 0))
+        self.assertEqual(OutboxSummary.objects.get(pigeon=self.pigeon).pruned, 2)
+
+    def test_unsent_messages_kept(self):
+        Outbox.objects.update(succeeded=False, sent_at=None)
+        self.assertEqual(prune_pigeons(days=0), (0, 0))
+        self.assertEqual(Outbox.objects.count(), 2)
+
+    def test_strip_only(self):
+        self.assertEqual(prune_pigeons(strip_only=True), (1, 0))
+        self.assertEqual(bytes(Outbox.objects.get(id=self.old.id).message), b'')
+        self.assertEqual(Outbox.objects.count(), 2)
+        self.assertFalse(OutboxSummary.objects.exists())
+        self.assertEqual(prune_pigeons(strip_only=True), (0, 0))
+        # The stripped message still stops the user getting the pigeon again
+        Pigeon.objects.filter(id=self.pigeon.id).update(to_send=True)
+        process_queue(force=True)
+        self.assertEqual(Outbox.objects.count(), 2)
+
+    def test_command(self):
+        out = StringIO()
+        call_command('prune_pigeons', days=30, summary=False, stdout=out)
+        self.assertEqual(out.getvalue(), 'Pruned 1 messages and 0 blobs\n')
+        self.assertFalse(OutboxSummary.objects.exists())
+
+
+class StopAfterWait(object):
+    """ Stands in for the daemon's stop event, stopping it at the first wait """
+
+    def __init__(self):
+        self.waits = []
+
+    def is_set(self):
+        return bool(self.waits)
+
+    def wait(self, timeout):
+        self.waits.append(timeout)
+
+
+class TestDaemon(TestCase):
+
+    def setUp(self):
+        # The example News pigeon is due in six hours
+        self.users, self.staff, self.message, self.pigeon = create_fixtures()
+
+    def test_sleep_until_due(self):
+        stop = StopAfterWait()
+        run_pigeons(poll_interval=24*60*60, stop=stop)
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertTrue(6*60*60 - 60 < stop.waits[0] <= 6*60*60)
+
+    def test_poll_interval(self):
+        stop = StopAfterWait()
+        run_pigeons(poll_interval=60, stop=stop)
+        self.assertEqual(stop.waits, [60])
+
+    def test_send_due(self):
+        Pigeon.objects.update(scheduled_for=now())
+        stop = StopAfterWait()
+        run_pigeons(poll_interval=60, stop=stop)
+        self.assertEqual(len(mail.outbox), 2)
+        # Nothing else is due
+        self.assertEqual(stop.waits, [60])
+
+    @override_settings(PIGEONPOST_SMTP_CONNECT_ATTEMPTS=1)
+    def test_no_progress(self):
+        """ Messages that couldn't be sent don't keep the daemon busy """
+        process_queue(force=True)
+        get_connection = mail.get_connection
+        mail.get_connection = UnreachableSMTPConnection
+        try:
+            stop = StopAfterWait()
+            run_pigeons(poll_interval=60, stop=stop)
+        finally:
+            mail.get_connection = get_connection
+        self.assertEqual(Outbox.objects.filter(succeeded=False, failures=0).count(), 2)
+        self.assertEqual(stop.waits, [60])
+
+    def test_claimed_and_failed_not_due(self):
+        process_queue(force=True)
+        self.assertEqual(tasks._seconds_until_due(60), tasks.MIN_POLL_INTERVAL)
+        Outbox.objects.update(failures=3)
+        self.assertEqual(tasks._seconds_until_due(60), 60)
+        self.assertEqual(tasks._seconds_until_due(60, max_retries=5), tasks.MIN_POLL_INTERVAL)
+        Outbox.objects.update(claimed_by='elsewhere', claimed_until=now() + datetime.timedelta(hours=1))
+        self.assertEqual(tasks._seconds_until_due(60, max_retries=5), 60)
+
+    def test_stopped(self):
+        """ Once stopped, no more messages are sent """
+        process_queue(force=True)
+        stop = threading.Event()
+        stop.set()
+        tasks.process_outbox(stop=stop)
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(Outbox.objects.filter(succeeded=False).count(), 2)
+
+
+@override_settings(PIGEONPOST_IMMEDIATE=True)
+class TestImmediate(TransactionTestCase):
+
+    def setUp(self):
+        self.users, self.staff, self.message, self.pigeon = create_fixtures(create_message=False)
+        # The test database can't be shared with the worker's thread, so the
+        # pigeons it is given are sent from this one
+        self.submitted = []
+        tasks.immediate_worker.submit = self.submitted.append
+
+    def tearDown(self):
+        del tasks.immediate_worker.submit
+
+    def _run_worker(self):
+        for key in self.submitted:
+            tasks._send_immediately(key)
+        self.submitted = []
+
+    def test_sent_after_commit(self):
+        with transaction.atomic():
+            ModeratedNews(subject='Test', body='A test message', published=True).save()
+            self.assertEqual(self.submitted, [])
+        self.assertEqual(len(self.submitted), 1)
+        self._run_worker()
+        self.assertEqual(sorted(email.to[0] for email in mail.outbox),
+                sorted(user.email for user in self.staff))
+        pigeon = Pigeon.objects.get(render_email_method='email_moderators')
+        self.assertFalse(pigeon.to_send)
+        self.assertEqual(Outbox.objects.filter(pigeon=pigeon, succeeded=True).count(), 2)
+        # The pigeon for everyone else still waits for its time
+        self.assertTrue(Pigeon.objects.get(render_email_method='email_news').to_send)
+
+    def test_rolled_back(self):
+        try:
+            with transaction.atomic():
+                ModeratedNews(subject='Test', body='A test message', published=True).save()
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(self.submitted, [])
+
+    @override_settings(PIGEONPOST_COALESCE_ON_COMMIT=True)
+    def test_coalesced(self):
+        """ Buffered pigeons are written before they are submitted, even with more queued after them """
+        pigeons_when_submitted = []
+        def submit(key):
+            pigeons_when_submitted.append(Pigeon.objects.count())
+            self.submitted.append(key)
+        tasks.immediate_worker.submit = submit
+        with transaction.atomic():
+            ModeratedNews(subject='Test', body='A test message', published=True).save()
+            News(subject='Later', body='Another message').save()
+        self.assertEqual(pigeons_when_submitted, [3])
+        self._run_worker()
+        self.assertEqual(sorted(email.to[0] for email in mail.outbox),
+                sorted(user.email for user in self.staff))
+
+    def test_defer_for_zero(self):
+        news = News.objects.create(subject='Test', body='A test message')
+        pigeonpost_queue.send(sender=news, defer_for=0)
+        self._run_worker()
+        self.assertEqual(len(mail.outbox), 2)
+
+    def test_already_sent(self):
+        """ Pigeons that deploy_pigeons got to first are left alone """
+        ModeratedNews(subject='Test', body='A test message', published=True).save()
+        process_queue()
+        send_email()
+        self._run_worker()
+        self.assertEqual(len(mail.outbox), 2)
+
+    def test_overlapping_outbox_run(self):
+        """ Messages that the worker is sending aren't also sent by deploy_pigeons """
+        ModeratedNews(subject='Test', body='A test message', published=True).save()
+        def overlap(sender, **kwargs):
+            # deploy_pigeons runs while the worker is sending its first message
+            pigeonpost_pre_send.disconnect(overlap)
+            send_email()
+        pigeonpost_pre_send.connect(overlap, weak=False)
+        with override_settings(PIGEONPOST_WARN_RUNTIME=60):
+            self._run_worker()
+        self.assertEqual(sorted(email.to[0] for email in mail.outbox),
+                sorted(user.email for user in self.staff))
+
+    @override_settings(PIGEONPOST_IMMEDIATE=False)
+    def test_opt_in(self):
+        ModeratedNews(subject='Test', body='A test message', published=True).save()
+        self.assertEqual(self.submitted, [])
+        self.assertTrue(Pigeon.objects.get(render_email_method='email_moderators').to_send)
+
+    def test_worker_thread(self):
+        sent = []
+        send_immediately = tasks._send_immediately
+        tasks._send_immediately = sent.append
+        try:
+            worker = tasks._ImmediateWorker()
+            worker.submit('a')
+            worker.submit('b')
+            worker.join()
+        finally:
+            tasks._send_immediately = send_immediately
+        self.assertEqual(sent, ['a', 'b'])
@@ -8,27 +8,40 @@ from django.template.loader import render_to_string
 
 
 class single_instance(object):
+    """
+    Only let one process at a time run the decorated function, using a pid
+    file. If another process holds the lock, exit, or with ``exit=False``
+    return None without calling the function.
+    """
 
-    def __init__(self, pidfile_name):
+    def __init__(self, pidfile_name, exit=True):
         self.pidfile_name = pidfile_name
+        self.exit = exit
 
     def __call__(self, f):
         def wrapped_f(*args,**kwargs):
+            if getattr(settings, 'PIGEONPOST_CLAIM_WORK', False):
+                # Workers share the work through the database instead, see
+                # pigeonpost.claiming
+                return f(*args,**kwargs)
             full_path = os.path.join(self.pidfile_name + '.pid')
             # Check if there is already a lock file existing
             if os.access(full_path, os.F_OK):
                 if self.check_pid(full_path):
-                    sys.exit(1)
+                    if self.exit:
+                        sys.exit(1)
+                    return
             # put a PID in the pid file
             self.create_pid_file(full_path)
             try:
-                f(*args,**kwargs)
+                result = f(*args,**kwargs)
             except:
                 # Catch any errors and delete pidfile
                 os.remove(full_path)
                 raise
 
             os.remove(full_path)
+            return result
         return wrapped_f
 
     def create_pid_file(self, fn):
@@ -68,6 +81,43 @@ class single_instance(object):
         return datetime.datetime.fromtimestamp(t)
 
 
+class IdSet(object):
+    """
+    A set of non-negative integer ids, stored as a bitmap.
+
+    Uses one bit per possible id, so remembering every user of a site with
+    a million users costs about 125kB, rather than a set of model instances.
+    """
+
+    def __init__(self, ids=()):
+        self._bits = bytearray()
+        for i in ids:
+            self.add(i)
+
+    def __contains__(self, i):
+        byte = i >> 3
+        return byte < len(self._bits) and bool(self._bits[byte] & (1 << (i & 7)))
+
+    def add(self, i):
+        byte = i >> 3
+        if byte >= len(self._bits):
+            # Grow geometrically so that adding ids in order is cheap
+            size = max(byte + 1, 2 * len(self._bits))
+            self._bits.extend(bytearray(size - len(self._bits)))
+        self._bits[byte] |= 1 << (i & 7)
+
+
+def user_agnostic(render_email):
+    """
+    Mark a render email method as building the same message for every user,
+    apart from ``to``. process_queue calls it once per pigeon, with the first
+    user it renders a message for, and gives every other user a copy
+    addressed to only their email.
+    """
+    render_email.user_agnostic = True
+    return render_email
+
+
 def generate_email(to_user, subject, context, text_template, html_template, from_email=None):
     """ Create an email with html and text versions.
 
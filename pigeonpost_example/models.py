@@ -3,6 +3,7 @@ from django.core.mail import EmailMessage
 from django.db import models
 
 from pigeonpost.signals import pigeonpost_queue
+from pigeonpost.utils import user_agnostic
 
 class Profile(models.Model):
     user = models.ForeignKey(User, unique=True)
@@ -43,11 +44,12 @@ class ModeratedNews(models.Model):
     def save(self, *args, **kwargs):
         super(ModeratedNews, self).save(*args, **kwargs)
         if self.published:
-            # sending ModeratedNews to moderators (nearly) immediately,
+            # sending ModeratedNews to moderators immediately (with
+            # PIGEONPOST_IMMEDIATE, otherwise on the next deploy_pigeons run),
             # and sending them to users in 6 hours if the ModeratedNews
             # items remain published.
             pigeonpost_queue.send(sender=self, render_email_method='email_news', defer_for=6*60*60) 
-            pigeonpost_queue.send(sender=self, render_email_method='email_moderators')
+            pigeonpost_queue.send(sender=self, render_email_method='email_moderators', immediate=True)
         
 
 class BobsNews(models.Model):
@@ -63,6 +65,23 @@ class BobsNews(models.Model):
         return User.objects.filter(first_name__iexact='bob')
 
 
+class Announcement(models.Model):
+    """ An announcement that is the same for every user """
+    subject = models.TextField()
+    body = models.TextField()
+
+    @user_agnostic
+    def render_email(self, user):
+        """
+        Only rendered once, the other users are sent copies addressed to them
+        """
+        return EmailMessage(self.subject, self.body, from_email='anon@example.com', to=[user.email])
+
+    def save(self, *args, **kwargs):
+        super(Announcement, self).save(*args, **kwargs)
+        pigeonpost_queue.send(sender=self, defer_for=6*60*60)
+
+
 class AggregateNews(models.Model):
     """ News that is aggregated as a single message """
     news_bit = models.TextField()
@@ -76,3 +95,13 @@ class AggregateNews(models.Model):
             msg_body.append(n.news_bit)
         return EmailMessage("The latest news!", "\n".join(msg_body),
                 from_email='anon@example.com', to=[user.email]) 
+
+    @classmethod
+    def render_email_bulk(cls, users):
+        """
+        Render the email for many users at once, only fetching the news once
+        """
+        body = "\n".join(n.news_bit for n in cls.objects.filter(read=False))
+        for user in users:
+            yield user, EmailMessage("The latest news!", body,
+                    from_email='anon@example.com', to=[user.email])